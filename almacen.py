@@ -0,0 +1,43 @@
+from sqlalchemy import update, select, case
+from models import Productos
+
+
+def reserva(sesion, pedidas):  # Descuenta del stock las cantidades pedidas y devuelve las que se han podido reservar
+    # pedidas es un diccionario {id_producto: cantidad}. La comprobación y la resta las hace la base de datos en el
+    # mismo UPDATE (stock = stock - cantidad WHERE stock >= cantidad), así dos pedidos a la vez nunca se llevan las
+    # mismas unidades. Si no queda stock suficiente de un producto se reserva lo que quede
+    reservadas = {}
+    if len(pedidas) == 0:
+        return reservadas
+    cantidad = case(pedidas, value=Productos.id)  # La cantidad pedida de cada producto
+    consulta = update(Productos).where(Productos.id.in_(list(pedidas)), Productos.eliminado == 0,
+                                       Productos.stock >= cantidad).values(
+        stock=Productos.stock - cantidad).execution_options(synchronize_session=False)
+    if sesion.get_bind().dialect.update_returning:  # Un solo UPDATE para todo el pedido
+        for id_producto in sesion.execute(consulta.returning(Productos.id)).scalars():
+            reservadas[id_producto] = pedidas[id_producto]
+    else:
+        for id_producto, unidades in pedidas.items():
+            if sesion.execute(_resta(id_producto, unidades)).rowcount > 0:
+                reservadas[id_producto] = unidades
+    for id_producto, unidades in pedidas.items():  # Los productos sin stock suficiente
+        if id_producto not in reservadas:
+            reservadas[id_producto] = _reserva_lo_que_queda(sesion, id_producto, unidades)
+    return reservadas
+
+
+def _resta(id_producto, unidades):  # UPDATE que quita unidades del stock solo si las hay
+    return update(Productos).where(Productos.id == id_producto, Productos.eliminado == 0,
+                                   Productos.stock >= unidades).values(
+        stock=Productos.stock - unidades).execution_options(synchronize_session=False)
+
+
+def _reserva_lo_que_queda(sesion, id_producto, unidades):
+    while True:  # Si otro pedido se lleva unidades entre la consulta y el UPDATE, lo volvemos a intentar
+        stock = sesion.execute(select(Productos.stock).where(Productos.id == id_producto,
+                                                             Productos.eliminado == 0)).scalar()
+        if stock is None or stock <= 0:
+            return 0
+        parte = min(stock, unidades)
+        if sesion.execute(_resta(id_producto, parte)).rowcount > 0:
+            return parte
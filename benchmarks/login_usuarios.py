@@ -0,0 +1,61 @@
+# Mide lo que tarda en encontrarse el usuario al iniciar sesión (la consulta de comprueba_usuario) con 100, 10.000 y
+# 1.000.000 de usuarios. Con --sin-indice se borra antes el índice ux_usuario_email_activo, para comparar
+#   python benchmarks/login_usuarios.py [--sin-indice] [--busquedas 1000]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date
+
+CARPETA = tempfile.mkdtemp(prefix="benchmark_")  # Base de datos propia, BASE_DATOS_URL se lee al importar db
+os.environ["BASE_DATOS_URL"] = "sqlite:///" + os.path.join(CARPETA, "login.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, text  # noqa: E402
+import db  # noqa: E402
+import migraciones  # noqa: E402
+from models import Usuario  # noqa: E402
+
+TAMANYOS = (100, 10000, 1000000)
+LOTE = 10000  # Usuarios que se insertan en cada INSERT
+
+
+def usuarios(desde, hasta):  # Filas de los usuarios con id entre desde y hasta (sin incluir)
+    return [{"id": id, "usuario": "usuario", "telefono": "600000000", "email": "usuario{}@tienda.es".format(id),
+             "contrasenia": "x", "nombre": "Nombre", "apellido": "Apellido", "direccion": "Calle 1",
+             "poblacion": "Madrid", "provincia": "Madrid", "admin": 2, "antiguedad": date.today(), "eliminado": 0}
+            for id in range(desde, hasta)]
+
+
+def mide(sin_indice, busquedas):
+    migraciones.actualiza_esquema(db.engine)
+    sesion = db.Session()
+    if sin_indice:
+        sesion.execute(text("DROP INDEX ux_usuario_email_activo"))
+    creados = 0
+    for tamanyo in TAMANYOS:
+        for desde in range(creados + 1, tamanyo + 1, LOTE):
+            sesion.execute(insert(Usuario), usuarios(desde, min(desde + LOTE, tamanyo + 1)))
+        sesion.commit()
+        creados = tamanyo
+        email = "usuario{}@tienda.es".format(tamanyo // 2)
+        inicio = time.perf_counter()
+        for _ in range(busquedas):
+            Usuario.activos(sesion).filter_by(email=email).first()
+            sesion.expunge_all()  # Como en cada petición, el usuario no está ya cargado en la sesión
+        print("{:>9} usuarios: {:.3f} ms por búsqueda".format(tamanyo, (time.perf_counter() - inicio) * 1000 / busquedas))
+    sesion.close()
+
+
+if __name__ == "__main__":
+    argumentos = argparse.ArgumentParser()
+    argumentos.add_argument("--sin-indice", action="store_true", help="Borra el índice de emails antes de medir")
+    argumentos.add_argument("--busquedas", type=int, default=1000, help="Búsquedas por cada número de usuarios")
+    argumentos = argumentos.parse_args()
+    try:
+        mide(argumentos.sin_indice, argumentos.busquedas)
+    finally:
+        db.engine.dispose()
+        shutil.rmtree(CARPETA, ignore_errors=True)
@@ -0,0 +1,138 @@
+# Compara el perfil de PRAGMAS de db.py con la configuración por defecto de SQLite (journal DELETE, synchronous FULL)
+# Sin --app, 2 procesos escriben movimientos de contabilidad y 4 leen páginas de 50 productos durante 5 segundos.
+# Con --app, 8 hilos hacen peticiones a la aplicación: un 30% crea pedidos y el resto lee páginas de productos
+#   python benchmarks/pragmas_sqlite.py [--perfil antiguo] [--app]
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+# Valores por defecto de SQLite, que db.py usaba antes de tener PRAGMAS
+ANTIGUO = {"journal_mode": "DELETE", "synchronous": "FULL", "busy_timeout": "5000", "mmap_size": "0",
+           "cache_size": "-2000", "temp_store": "DEFAULT"}
+DURACION = 5  # Segundos que dura cada medida
+ARRANQUE = 3  # Segundos que esperan los procesos a que arranquen todos, así empiezan a la vez
+ESCRITORES = 2
+LECTORES = 4
+HILOS = 8
+PRODUCTOS = 20000
+EMAIL = "cliente@tienda.es"
+CONTRASENIA = "contrasenia"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def prepara():  # Crea el esquema, los productos, el saldo y un cliente (id 1)
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+    import db
+    import migraciones
+    from models import Categoria, Productos, Proveedor, Saldo, Usuario
+    migraciones.actualiza_esquema(db.engine)
+    sesion = db.Session()
+    sesion.add(Usuario("cliente", "600000001", EMAIL, generate_password_hash(CONTRASENIA), "Cliente", "Tienda",
+                       "Calle 2", "Madrid", "Madrid"))
+    sesion.add(Proveedor("Logitech", "B00000000", "910000000", "ventas@logitech.es", "Calle 3", "Madrid", "Madrid"))
+    sesion.add(Categoria("Ratones", "../static/imagenes/ratones.png"))
+    sesion.add(Saldo(0))
+    sesion.execute(insert(Productos), [
+        {"categoria": "Ratones", "marca": "Logitech", "modelo": "M{}".format(numero), "descripcion": "Ratón",
+         "id_proveedor": 1, "precio_compra": 1, "precio_venta": 2, "iva": 21, "cantidad_max": 10, "stock": 10 ** 9,
+         "precio_final": 2.42, "eliminado": 0} for numero in range(PRODUCTOS)])
+    sesion.commit()
+    sesion.close()
+    db.engine.dispose()
+
+
+def trabaja(escritor, inicio, cola):  # Proceso que escribe o lee hasta que se acaba el tiempo
+    import db
+    import libro_mayor
+    from models import Contabilidad, Productos
+    time.sleep(max(0, inicio - time.time()))
+    hechas = 0
+    while time.time() < inicio + DURACION:
+        sesion = db.Session()
+        if escritor:
+            libro_mayor.registra(sesion, Contabilidad(id_producto=1, id_cliente=1, id_proveedor=1, cantidad=1), 1, 1)
+            sesion.commit()
+        else:
+            Productos.activos(sesion).filter(Productos.id > hechas * 50 % PRODUCTOS).order_by(Productos.id).limit(
+                50).all()
+        sesion.close()
+        hechas += 1
+    cola.put((escritor, hechas))
+
+
+def procesos():
+    contexto = multiprocessing.get_context("spawn")  # Cada proceso abre sus propias conexiones
+    cola = contexto.Queue()
+    inicio = time.time() + ARRANQUE
+    trabajos = [contexto.Process(target=trabaja, args=(numero < ESCRITORES, inicio, cola))
+                for numero in range(ESCRITORES + LECTORES)]
+    for trabajo in trabajos:
+        trabajo.start()
+    resultados = [cola.get(timeout=ARRANQUE + DURACION + 60) for _ in trabajos]
+    for trabajo in trabajos:
+        trabajo.join()
+    escrituras = sum(hechas for escritor, hechas in resultados if escritor)
+    lecturas = sum(hechas for escritor, hechas in resultados if not escritor)
+    print("escrituras/s: {:.0f}, lecturas/s: {:.0f}".format(escrituras / DURACION, lecturas / DURACION))
+
+
+def aplicacion():
+    import jinja2
+    import main
+    main.app.config["TESTING"] = True
+    main.app.jinja_loader = jinja2.FunctionLoader(lambda nombre: "")  # Las plantillas no están en el repositorio
+    cuentas = []
+    fin = time.time() + DURACION
+
+    def navega(semilla):
+        navegador = main.app.test_client()
+        navegador.post("/comprueba_usuario", data={"email": EMAIL, "contrasenia": CONTRASENIA})
+        azar = random.Random(semilla)
+        cuenta = {"pedidos": 0, "lecturas": 0, "errores": 0}
+        while time.time() < fin:
+            if azar.random() < 0.3:
+                respuesta = navegador.post("/crear_pedido", data={"id": [str(azar.randint(1, PRODUCTOS))],
+                                                                 "cantidad": ["1"]})
+                cuenta["pedidos" if respuesta.status_code == 302 else "errores"] += 1
+            else:
+                respuesta = navegador.get("/productos?por_pagina=50")
+                cuenta["lecturas" if respuesta.status_code == 200 else "errores"] += 1
+        cuentas.append(cuenta)
+
+    hilos = [threading.Thread(target=navega, args=(numero,)) for numero in range(HILOS)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+    total = {clave: sum(cuenta[clave] for cuenta in cuentas) for clave in cuentas[0]}
+    print("peticiones/s: {:.0f} (pedidos: {}, lecturas: {}, errores: {})".format(
+        (total["pedidos"] + total["lecturas"]) / DURACION, total["pedidos"], total["lecturas"], total["errores"]))
+
+
+if __name__ == "__main__":
+    argumentos = argparse.ArgumentParser()
+    argumentos.add_argument("--perfil", choices=["actual", "antiguo"], default="actual",
+                            help="actual usa PRAGMAS de db.py, antiguo los valores por defecto de SQLite")
+    argumentos.add_argument("--app", action="store_true", help="Mide peticiones a la aplicación en vez de procesos")
+    argumentos = argumentos.parse_args()
+    carpeta = tempfile.mkdtemp(prefix="benchmark_")
+    # db.py lee la URL al importarse y los PRAGMAS al abrir cada conexión, los procesos heredan el entorno
+    os.environ["BASE_DATOS_URL"] = "sqlite:///" + os.path.join(carpeta, "pragmas.db")
+    if argumentos.perfil == "antiguo":
+        os.environ.update({"SQLITE_" + nombre.upper(): valor for nombre, valor in ANTIGUO.items()})
+    try:
+        prepara()
+        print("Perfil {}:".format(argumentos.perfil), end=" ")
+        if argumentos.app:
+            aplicacion()
+        else:
+            procesos()
+    finally:
+        shutil.rmtree(carpeta, ignore_errors=True)
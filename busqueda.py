@@ -0,0 +1,49 @@
+import re
+from sqlalchemy import column, table, text, or_, literal
+from models import Productos
+
+# Índice de texto completo de SQLite sobre la marca, el modelo y la descripción de los productos. Es una tabla FTS5
+# de contenido externo: solo guarda el índice y lee el texto de la tabla producto. Los triggers lo mantienen al día
+# cada vez que se crea, edita o borra un producto (migraciones.crea_busqueda los crea)
+TABLA = "producto_fts"
+producto_fts = table(TABLA, column("rowid"), column("rank"))
+DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS producto_fts USING fts5(marca, modelo, descripcion, content='producto', "
+    "content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS producto_fts_insert AFTER INSERT ON producto BEGIN "
+    "INSERT INTO producto_fts(rowid, marca, modelo, descripcion) VALUES (new.id, new.marca, new.modelo, "
+    "new.descripcion); END",
+    "CREATE TRIGGER IF NOT EXISTS producto_fts_delete AFTER DELETE ON producto BEGIN "
+    "INSERT INTO producto_fts(producto_fts, rowid, marca, modelo, descripcion) VALUES ('delete', old.id, old.marca, "
+    "old.modelo, old.descripcion); END",
+    # Solo cuando cambia el texto, las actualizaciones del stock no tocan el índice
+    "CREATE TRIGGER IF NOT EXISTS producto_fts_update AFTER UPDATE OF marca, modelo, descripcion ON producto BEGIN "
+    "INSERT INTO producto_fts(producto_fts, rowid, marca, modelo, descripcion) VALUES ('delete', old.id, old.marca, "
+    "old.modelo, old.descripcion); "
+    "INSERT INTO producto_fts(rowid, marca, modelo, descripcion) VALUES (new.id, new.marca, new.modelo, "
+    "new.descripcion); END",
+)
+TRIGGERS = ("producto_fts_insert", "producto_fts_delete", "producto_fts_update")
+
+
+def palabras(texto):  # Palabras de la búsqueda, sin los signos que tienen significado en la sintaxis de FTS5
+    return re.findall(r"\w+", texto.lower())
+
+
+def busca(sesion, texto, categoria=None):  # Consulta de los productos que contienen todas las palabras del texto
+    # Devuelve la consulta y las columnas por las que hay que ordenarla, de más a menos relevante. Cada palabra puede
+    # ser el principio de una palabra del producto ("logi" encuentra "Logitech")
+    consulta = Productos.activos(sesion)
+    if categoria:
+        consulta = consulta.filter(Productos.categoria == categoria)
+    if sesion.get_bind().dialect.name != "sqlite":  # Sin FTS5 buscamos cada palabra con LIKE, sin relevancia
+        for palabra in palabras(texto):
+            patron = "%" + palabra + "%"
+            consulta = consulta.filter(or_(Productos.marca.ilike(patron), Productos.modelo.ilike(patron),
+                                           Productos.descripcion.ilike(patron)))
+        return consulta.add_columns(literal(0).label("rank")), [Productos.id]
+    # bm25 es negativo y más pequeño cuanto más relevante es el producto, así que se ordena de menor a mayor
+    expresion = " ".join('"{}"*'.format(palabra) for palabra in palabras(texto))
+    consulta = consulta.join(producto_fts, producto_fts.c.rowid == Productos.id).filter(
+        text("producto_fts MATCH :expresion").bindparams(expresion=expresion)).add_columns(producto_fts.c.rank)
+    return consulta, [producto_fts.c.rank, Productos.id]
@@ -1,16 +1,80 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+import os
+import threading
+from flask import has_app_context
+from flask.globals import app_ctx
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, declarative_base, scoped_session
+from sqlalchemy.pool import QueuePool
+
+# Dirección de la base de datos, con BASE_DATOS_URL se puede usar otra (por ejemplo postgresql://...)
+URL = make_url(os.environ.get("BASE_DATOS_URL", "sqlite:///database/suministros_informaticos.db"))
+
+# Configuración de cada conexión a SQLite, cada valor se puede cambiar con la variable de entorno SQLITE_<NOMBRE>
+PRAGMAS = {
+    "journal_mode": "WAL",  # Los lectores no esperan a los escritores ni los escritores a los lectores
+    "synchronous": "NORMAL",  # Con WAL sigue siendo seguro y los commits no esperan a que el disco escriba
+    "busy_timeout": "5000",  # Milisegundos que espera una escritura a que termine otra antes de fallar
+    "mmap_size": "268435456",  # Lee hasta 256 MB de la base de datos directamente de memoria
+    "cache_size": "-65536",  # Caché de páginas de cada conexión, en negativo son KB (64 MB)
+    "temp_store": "MEMORY",  # Tablas temporales y ordenaciones en memoria en vez de en disco
+}
 
 # El engine permite a SQLAlchemy comunicarse con la base de datos en un dialecto concreto
 # https://docs.sqlalchemy.org/en/20/core/engines.html
-engine = create_engine('sqlite:///database/suministros_informaticos.db',
-                       connect_args={"check_same_thread": False})
+# Cada petición usa su propia conexión del pool. Su tamaño se puede cambiar con variables de entorno: conexiones que
+# se mantienen abiertas, conexiones extra en los picos, si se comprueba la conexión antes de usarla y cada cuántos
+# segundos se renueva (-1 para no renovarlas nunca)
+POOL = {"pool_pre_ping": os.environ.get("POOL_PRE_PING", "0") == "1",
+        "pool_recycle": int(os.environ.get("POOL_RECICLAJE", "-1"))}
+# El tamaño solo se puede elegir si el dialecto usa un QueuePool (SQLite en memoria usa SingletonThreadPool)
+if issubclass(URL.get_dialect().get_pool_class(URL), QueuePool):
+    POOL.update(pool_size=int(os.environ.get("POOL_TAMANYO", "5")),
+                max_overflow=int(os.environ.get("POOL_DESBORDE", "10")))
+engine = create_engine(URL,
+                       # Las conexiones del pool pasan de un hilo a otro
+                       connect_args={"check_same_thread": False} if URL.get_backend_name() == "sqlite" else {},
+                       **POOL)
 # Advertencia: Crear el engine no conecta inmediatamente con la DB, eso lo hacemos luego
 
+
+def _configura_sqlite(conexion, registro):  # Aplica los PRAGMAS a cada conexión nueva del pool
+    cursor = conexion.cursor()
+    for nombre, valor in PRAGMAS.items():
+        cursor.execute("PRAGMA {} = {}".format(nombre, os.environ.get("SQLITE_" + nombre.upper(), valor)))
+    cursor.close()
+
+
+if URL.get_backend_name() == "sqlite":
+    event.listen(engine, "connect", _configura_sqlite)
+
+
+def _contexto():  # Cada contexto de Flask (una petición o un comando) tiene su propia sesión, fuera de Flask cada hilo
+    if has_app_context():
+        return id(app_ctx._get_current_object())
+    return threading.get_ident()
+
+
 # Ahora creamos la sesión, lo que nos permite realizar transacciones (operaciones)dentro de nuestra DB
 Session = sessionmaker(bind=engine)  # Esto crea una clase especial
-session = Session()  # Objeto de la clase Session, para hacer tareas en la base de datos
+# session se usa como un objeto Session, pero cada petición recibe una sesión distinta que se cierra al terminar
+# (db.session.remove() en main.py), así las peticiones a la vez no comparten conexión ni objetos cargados
+session = scoped_session(Session, scopefunc=_contexto)
 
 # Ahora vamos al fichero models.py en los modelos (clases) donde quereemos que se transformen en tablas,
 # le añadiremos esta variable y esto se encarga de mapear y vincular cada clase a cada tabla
 Base = declarative_base()  # Usamos Base para decir que clases convertimos en tabla y cual no
+
+
+def actualiza_o_crea(sesion, actualiza, crea):  # Actualiza una fila o la crea si no existe, aunque haya concurrencia
+    # actualiza ejecuta el UPDATE y devuelve None si no ha encontrado la fila. crea añade la fila a la sesión. Devuelve
+    # lo que devuelva la función que ha tenido éxito
+    resultado = actualiza()
+    if resultado is not None:
+        return resultado
+    try:
+        with sesion.begin_nested():  # Si otro proceso crea la fila a la vez, solo deshacemos este insert
+            return crea()
+    except IntegrityError:  # La fila ya existe, así que la actualizamos
+        return actualiza()
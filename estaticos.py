@@ -0,0 +1,44 @@
+import hashlib
+import os
+import re
+import threading
+
+UN_ANYO = 365 * 24 * 60 * 60  # Segundos que el navegador guarda un archivo cuya URL cambia con su contenido
+BLOQUE = 64 * 1024
+# Las imágenes subidas (ver imagenes.recibe) ya se llaman como el hash de su contenido
+CON_HASH = re.compile(r"^[0-9a-f]{32}(_\d+)?\.\w+$")
+_huellas = {}  # Ruta del archivo -> (fecha de modificación, tamaño, huella)
+_cerrojo = threading.Lock()
+
+
+def huella(carpeta, nombre):  # Hash corto del contenido de un archivo estático, o None si no existe
+    # Solo se vuelve a leer el archivo si ha cambiado su fecha de modificación o su tamaño
+    ruta = os.path.join(carpeta, nombre)
+    try:
+        estado = os.stat(ruta)
+    except OSError:
+        return None
+    with _cerrojo:
+        guardada = _huellas.get(ruta)
+    if guardada is not None and guardada[:2] == (estado.st_mtime_ns, estado.st_size):
+        return guardada[2]
+    resumen = hashlib.sha1()
+    with open(ruta, "rb") as archivo:
+        for bloque in iter(lambda: archivo.read(BLOQUE), b""):
+            resumen.update(bloque)
+    with _cerrojo:
+        _huellas[ruta] = (estado.st_mtime_ns, estado.st_size, resumen.hexdigest()[:12])
+    return _huellas[ruta][2]
+
+
+def cabeceras(respuesta, carpeta, nombre, version):  # Cabeceras de caché de un archivo estático
+    # Si la URL identifica el contenido (lleva su huella en ?v= o el nombre es un hash), el archivo nunca cambia y el
+    # navegador lo guarda un año sin volver a preguntar. Si no, tiene que revalidarlo con ETag y Last-Modified
+    if CON_HASH.match(os.path.basename(nombre)) or (version is not None and version == huella(carpeta, nombre)):
+        respuesta.cache_control.no_cache = None
+        respuesta.cache_control.public = True
+        respuesta.cache_control.max_age = UN_ANYO
+        respuesta.cache_control.immutable = True
+    else:
+        respuesta.cache_control.no_cache = True
+    return respuesta
@@ -0,0 +1,59 @@
+import csv
+import io
+from models import Factura, FacturaLinea, Pedido, PedidoLinea, Productos, Contabilidad, Usuario
+
+POR_LOTE = 1000  # Filas que se leen de la base de datos y se envían al navegador cada vez
+TIPOS = ("facturas", "pedidos", "contabilidad")
+
+
+def consulta(sesion, tipo, desde=None, hasta=None, id_cliente=None):  # Devuelve la cabecera del CSV y su consulta
+    # Una fila por cada línea de factura o de pedido y por cada movimiento de contabilidad, entre las fechas desde y
+    # hasta (incluidas) y solo de un cliente si se indica id_cliente
+    if tipo == "facturas":
+        cabecera = ["factura", "fecha", "id_cliente", "cliente", "total", "id_producto", "categoria", "marca",
+                    "modelo", "cantidad", "precio_venta", "iva", "precio_final"]
+        filas = sesion.query(Factura.id, Factura.fecha, Factura.id_cliente, Usuario.usuario, Factura.total,
+                             FacturaLinea.id_producto, FacturaLinea.categoria, FacturaLinea.marca, FacturaLinea.modelo,
+                             FacturaLinea.cantidad, FacturaLinea.precio_venta, FacturaLinea.iva,
+                             FacturaLinea.precio_final).join(Usuario, Usuario.id == Factura.id_cliente).outerjoin(
+            FacturaLinea, FacturaLinea.id_factura == Factura.id).order_by(Factura.id, FacturaLinea.id)
+        fecha, cliente = Factura.fecha, Factura.id_cliente
+    elif tipo == "pedidos":
+        cabecera = ["pedido", "fecha", "id_cliente", "cliente", "id_producto", "categoria", "marca", "modelo",
+                    "cantidad"]
+        filas = sesion.query(Pedido.id, Pedido.fecha, Pedido.id_cliente, Usuario.usuario, PedidoLinea.id_producto,
+                             Productos.categoria, Productos.marca, Productos.modelo, PedidoLinea.cantidad).join(
+            Usuario, Usuario.id == Pedido.id_cliente).join(PedidoLinea, PedidoLinea.id_pedido == Pedido.id).join(
+            Productos, Productos.id == PedidoLinea.id_producto).order_by(Pedido.id, PedidoLinea.id)
+        fecha, cliente = Pedido.fecha, Pedido.id_cliente
+    else:
+        cabecera = ["movimiento", "fecha", "id_producto", "id_cliente", "id_proveedor", "cantidad", "beneficio"]
+        filas = sesion.query(Contabilidad.id, Contabilidad.fecha, Contabilidad.id_producto, Contabilidad.id_cliente,
+                             Contabilidad.id_proveedor, Contabilidad.cantidad, Contabilidad.beneficio).order_by(
+            Contabilidad.id)
+        fecha, cliente = Contabilidad.fecha, Contabilidad.id_cliente
+    if desde is not None:
+        filas = filas.filter(fecha >= desde)
+    if hasta is not None:
+        filas = filas.filter(fecha <= hasta)
+    if id_cliente is not None:
+        filas = filas.filter(cliente == id_cliente)
+    return cabecera, filas
+
+
+def csv_por_lotes(cabecera, filas):  # Generador con el CSV en trozos de POR_LOTE filas
+    # yield_per lee las filas de la base de datos por lotes en vez de cargarlas todas, así la memoria no depende del
+    # tamaño de la exportación
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    escritor.writerow(cabecera)
+    yield buffer.getvalue()  # La descarga empieza antes de ejecutar la consulta
+    buffer.seek(0)
+    buffer.truncate()
+    for numero, fila in enumerate(filas.yield_per(POR_LOTE), 1):
+        escritor.writerow(fila)
+        if numero % POR_LOTE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
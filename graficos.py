@@ -0,0 +1,169 @@
+import calendar
+import hashlib
+import io
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import func, select, update
+import db
+from models import Contabilidad, Productos, VersionDatos
+
+# matplotlib, seaborn y pandas solo se cargan en los procesos que dibujan (ver _librerias), así los workers web
+# arrancan antes y ocupan menos memoria. A los procesos se les pasan listas y diccionarios, no dataframes
+
+MAX_GRAFICOS = 64  # Número máximo de gráficas que guarda en memoria cada worker
+MAX_PROCESOS = 2  # Número de procesos que dibujan gráficas para cada worker
+# Segundos que /grafico espera a que una gráfica termine de dibujarse, con un hilo del worker bloqueado mientras tanto
+ESPERA_MAXIMA = 30
+VERSION = 1  # id de la única fila de la tabla version_datos
+_cache = OrderedDict()  # Gráficas pedidas (Future con el PNG), de la menos a la más usada recientemente
+_cerrojo = threading.Lock()  # Protege la caché y el pool cuando el worker atiende varias peticiones a la vez
+_pool = None  # Se crea la primera vez que se pide una gráfica
+
+
+def version_datos():  # La versión de los datos es el último movimiento de contabilidad y el contador de cambios
+    # crear_producto, crear_factura y las importaciones escriben en contabilidad. Lo que cambia las gráficas sin
+    # escribir en contabilidad (editar los precios de un producto, reconstruir el resumen mensual) llama a cambia_datos
+    movimiento, cambios = db.session.query(
+        select(func.max(Contabilidad.id)).scalar_subquery(),
+        select(VersionDatos.version).where(VersionDatos.id == VERSION).scalar_subquery()).one()
+    return "{}.{}".format(movimiento or 0, cambios or 0)
+
+
+def cambia_datos(sesion):  # Hace avanzar la versión de los datos, en la transacción de la sesión
+    consulta = update(VersionDatos).where(VersionDatos.id == VERSION).values(
+        version=VersionDatos.version + 1).execution_options(synchronize_session=False)
+    db.actualiza_o_crea(sesion, lambda: sesion.execute(consulta).rowcount or None,
+                        lambda: sesion.add(VersionDatos(version=1, id=VERSION)))
+
+
+def etag(tipo, anyo, propietario, version):  # Identifica una gráfica sin necesidad de dibujarla
+    clave = "{}/{}/{}/{}".format(tipo, anyo, propietario, version)
+    return hashlib.sha1(clave.encode()).hexdigest()
+
+
+def _procesos():
+    global _pool
+    if _pool is None:  # spawn evita copiar al hijo las conexiones y los hilos del worker
+        _pool = ProcessPoolExecutor(max_workers=MAX_PROCESOS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def encarga(tipo, anyo, propietario, version, dibuja, datos):  # Manda dibujar la gráfica si no está ya en caché
+    # dibuja es una función de este módulo que devuelve el PNG, datos una función que devuelve sus argumentos.
+    # Devuelve un Future con el PNG, así la página no espera a que se termine de dibujar
+    global _pool
+    clave = (tipo, anyo, propietario, version)
+    with _cerrojo:
+        if clave in _cache:
+            _cache.move_to_end(clave)  # La marco como la más usada
+            return _cache[clave]
+    argumentos = datos()  # Solo consultamos la base de datos si hay que dibujarla
+    with _cerrojo:
+        if clave in _cache:  # Otra petición la ha encargado mientras consultábamos
+            return _cache[clave]
+        try:
+            futuro = _procesos().submit(dibuja, *argumentos)
+        except BrokenProcessPool:  # Si un proceso ha muerto, el pool ya no sirve y creamos otro
+            _pool = None
+            futuro = _procesos().submit(dibuja, *argumentos)
+        for antigua in [c for c in _cache if c[:3] == clave[:3]]:  # Las versiones anteriores ya no sirven
+            del _cache[antigua]
+        _cache[clave] = futuro
+        while len(_cache) > MAX_GRAFICOS:  # Expulso las gráficas que hace más tiempo que no se usan
+            _cache.popitem(last=False)
+    futuro.add_done_callback(lambda f: _descarta_fallida(clave, f))
+    return futuro
+
+
+def _descarta_fallida(clave, futuro):  # Si falla el dibujo, lo quitamos de la caché para reintentarlo
+    if futuro.exception() is not None:
+        with _cerrojo:
+            if _cache.get(clave) is futuro:
+                del _cache[clave]
+
+
+def datos_beneficio():  # Modelo, precio final y precio de compra de cada producto, para dibuja_beneficio
+    return [tuple(fila) for fila in db.session.query(Productos.modelo, Productos.precio_final, Productos.precio_compra)]
+
+
+def _librerias():  # Carga las librerías de dibujo la primera vez que un proceso dibuja una gráfica
+    import matplotlib
+    matplotlib.use("Agg")  # Dibuja solo en memoria, sin abrir ventanas
+    from matplotlib.figure import Figure
+    import pandas as pd
+    import seaborn as sns
+    return Figure, pd, sns
+
+
+def crea_df(productos):  # Función que me crea Dataframes pasándole los datos de los productos
+    pd = _librerias()[1]
+    precios_totales = []
+    for i in productos:
+        precios = []
+        precios.append(i[0])  # Modelo
+        precios.append(i[1])  # Precio final
+        precios.append(i[2])  # Precio de compra
+        precios_totales.append(precios)
+    return pd.DataFrame(precios_totales, columns=['Productos', "Precio Compra", "Precio Venta"])
+
+
+def df_contabilidad(meses, admin):  # Dataframe con la contabilidad de un año por meses, a partir de {mes: valor}
+    pd = _librerias()[1]
+    nombre_meses = []
+    cantidades = []
+    anterior = 0
+    for num_mes in range(1, 13):  # Asigno a cada mes la cantidad de ventas
+        nombre_meses.append(calendar.month_name[num_mes])
+        if num_mes in meses:
+            anterior = meses[num_mes]
+            cantidades.append(anterior)
+        elif admin and num_mes > min(meses):  # Si no hay movimientos el beneficio es el del mes anterior
+            cantidades.append(anterior)
+        else:
+            cantidades.append(0)
+
+    return pd.DataFrame({'mes': nombre_meses, 'beneficio': cantidades})  # Creo un Dataframe
+
+
+def _png(figura):  # Guarda la figura en memoria, nunca en disco
+    buffer = io.BytesIO()
+    figura.savefig(buffer, format="png", bbox_inches='tight')  # bbox_inches='tight', hace que se guarde la imagen completa
+    return buffer.getvalue()
+
+
+def dibuja_beneficio(productos, mayor):  # Gráfica de barras con los 10 productos de mayor o menor beneficio
+    # productos es la lista de datos_beneficio()
+    Figure = _librerias()[0]
+    df_beneficio = crea_df(productos)
+    df_beneficio['beneficio'] = df_beneficio['Precio Venta'] - df_beneficio['Precio Compra']
+    df = df_beneficio.sort_values(by="beneficio", ascending=mayor).head(10).drop('beneficio', axis=1)
+    titulo = "MAYOR BENEFICIO" if mayor else "MENOR BENEFICIO"
+    figura = Figure()  # Usamos Figure en vez de pyplot, que guarda estado global
+    ax = figura.subplots()
+    df.plot(x="Productos", kind="bar", stacked=True, rot=70, ax=ax)
+    ax.set_title(titulo, color="red", fontweight="bold")
+    ax.set_xlabel("Productos", color="red")
+    ax.set_ylabel("EUROS (€)", color="red")
+    return _png(figura)
+
+
+def dibuja_contabilidad(meses, anyo, admin):  # Gráfica con la contabilidad de un año, a partir de {mes: valor}
+    Figure, pd, sns = _librerias()
+    df = df_contabilidad(meses, admin)
+    figura = Figure()
+    ax = figura.subplots()
+    if admin:
+        sns.lineplot(x='mes', y='beneficio', data=df, ax=ax)  # Creo una gráfica de líneas con los valores del dataframe
+    else:
+        sns.barplot(x='mes', y='beneficio', data=df, ax=ax)
+    ax.set_title("Contabilidad " + str(anyo), color="red", fontweight="bold")
+    ax.set_xlabel("Meses", color="red")
+    if admin:
+        ax.set_ylabel("Beneficios", color="red")
+    else:
+        ax.set_ylabel("Gasto por mes", color="red")
+    ax.tick_params(axis="x", labelrotation=30)  # Roto los valores del eje x para que no se pisen
+    return _png(figura)
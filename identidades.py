@@ -0,0 +1,44 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import g
+from models import Usuario
+
+MAX_USUARIOS = 1024  # Número máximo de usuarios que guarda en memoria cada worker
+DURACION = 30  # Segundos que un usuario sigue en caché antes de volver a leerlo de la base de datos
+_cache = OrderedDict()  # id -> (momento en que caduca, usuario sin sesión), del menos al más usado recientemente
+_cerrojo = threading.Lock()  # Protege la caché cuando el worker atiende varias peticiones a la vez
+
+
+def carga(sesion, id):  # Devuelve el usuario logueado sin consultar la base de datos si está en caché
+    id = int(id)
+    if "usuario_logueado" in g:  # Ya lo hemos cargado en esta petición
+        return g.usuario_logueado
+    with _cerrojo:
+        guardado = _cache.get(id)
+        if guardado is not None and guardado[0] < time.monotonic():  # Ha caducado
+            del _cache[id]
+            guardado = None
+        if guardado is not None:
+            _cache.move_to_end(id)
+    if guardado is None:
+        usuario = Usuario.activos(sesion).filter_by(id=id).first()
+        if usuario is None:  # Los usuarios eliminados no pueden seguir logueados
+            g.usuario_logueado = None
+            return None
+        sesion.expunge(usuario)  # La copia de la caché no pertenece a ninguna sesión
+        guardado = (time.monotonic() + DURACION, usuario)
+        with _cerrojo:
+            _cache[id] = guardado
+            while len(_cache) > MAX_USUARIOS:  # Expulso los usuarios que hace más tiempo que no se usan
+                _cache.popitem(last=False)
+    # merge con load=False copia el usuario a la sesión de la petición sin hacer ninguna consulta
+    g.usuario_logueado = sesion.merge(guardado[1], load=False)
+    return g.usuario_logueado
+
+
+def olvida(id):  # Quita un usuario de la caché, hay que llamarla cada vez que se modifica o elimina un usuario
+    with _cerrojo:
+        _cache.pop(int(id), None)
+    if "usuario_logueado" in g and g.usuario_logueado is not None and g.usuario_logueado.id == int(id):
+        g.pop("usuario_logueado")
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import update
+import db
+from models import Categoria
+
+CARPETA = "static/imagenes"  # Carpeta donde se guardan las imágenes y sus miniaturas
+RUTA = "../static/imagenes/"  # Ruta de esa carpeta en las páginas
+ANCHOS = (200, 400)  # Anchos de las miniaturas, 400 para pantallas de alta densidad
+FORMATOS = {"webp": "WEBP", "png": "PNG"}  # Extensión y formato de PIL de cada miniatura
+MAX_HILOS = 2  # Hilos que generan miniaturas en cada worker
+BLOQUE = 64 * 1024  # Bytes que leemos de la subida cada vez
+# Formato de la imagen según sus primeros bytes, no decodificamos la imagen mientras el usuario espera
+FIRMAS = ((b"\x89PNG\r\n\x1a\n", "png"), (b"\xff\xd8\xff", "jpg"), (b"GIF87a", "gif"), (b"GIF89a", "gif"))
+_cerrojo = threading.Lock()
+_pool = None  # Se crea la primera vez que se sube una imagen
+_encargadas = {}  # Imágenes cuyas miniaturas se están generando, con su Future
+_log = logging.getLogger(__name__)
+
+
+def recibe(fichero):  # Guarda la imagen subida en un formulario y devuelve su ruta, o None si no es una imagen
+    # La subida se copia a disco por bloques mientras se calcula su hash, que es el nombre del archivo. Así una imagen
+    # que ya se había subido no se vuelve a guardar ni a procesar
+    os.makedirs(CARPETA, exist_ok=True)
+    resumen = hashlib.sha256()
+    descriptor, temporal = tempfile.mkstemp(dir=CARPETA, suffix=".subida")
+    try:
+        with os.fdopen(descriptor, "wb") as destino:
+            cabecera = b""
+            while True:
+                bloque = fichero.stream.read(BLOQUE)
+                if not bloque:
+                    break
+                if len(cabecera) < 12:
+                    cabecera += bloque[:12]
+                resumen.update(bloque)
+                destino.write(bloque)
+        extension = _extension(cabecera)
+        if extension is None:
+            return None
+        nombre = "{}.{}".format(resumen.hexdigest()[:32], extension)
+        if os.path.exists(os.path.join(CARPETA, nombre)):  # La misma imagen ya estaba subida
+            return RUTA + nombre
+        os.replace(temporal, os.path.join(CARPETA, nombre))
+        return RUTA + nombre
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+
+def _extension(cabecera):
+    for firma, extension in FIRMAS:
+        if cabecera.startswith(firma):
+            return extension
+    if cabecera[:4] == b"RIFF" and cabecera[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def encarga_miniaturas(ruta):  # Genera en segundo plano las miniaturas de una imagen subida con recibe
+    # Cuando terminan se guardan en todas las categorías que usan esa imagen
+    global _pool
+    variantes = _variantes(ruta)
+    if all(os.path.exists(_archivo(archivo)) for formatos in variantes.values() for archivo in formatos.values()):
+        _guarda_variantes(ruta, variantes)  # Ya se habían generado para otra categoría
+        return None
+    with _cerrojo:
+        if ruta in _encargadas:  # Otra categoría con la misma imagen ya las ha encargado, al terminar se guardan en las dos
+            return _encargadas[ruta]
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=MAX_HILOS, thread_name_prefix="miniaturas")
+        futuro = _encargadas[ruta] = _pool.submit(_genera, ruta, variantes)
+    futuro.add_done_callback(lambda f: _termina(ruta))
+    return futuro
+
+
+def _termina(ruta):
+    with _cerrojo:
+        _encargadas.pop(ruta, None)
+
+
+def _variantes(ruta):  # {ancho: {formato: ruta}} de las miniaturas de una imagen
+    base = os.path.splitext(ruta)[0]
+    return {str(ancho): {formato: "{}_{}.{}".format(base, ancho, formato) for formato in FORMATOS} for ancho in ANCHOS}
+
+
+def _archivo(ruta):  # Ruta en disco de una ruta de la página
+    return os.path.join(CARPETA, ruta[len(RUTA):])
+
+
+def _genera(ruta, variantes):
+    try:
+        from PIL import Image  # Se carga la primera vez que se genera una miniatura
+        with Image.open(_archivo(ruta)) as original:
+            original.load()
+            for ancho, formatos in variantes.items():
+                miniatura = original.copy()
+                miniatura.thumbnail((int(ancho), int(ancho)))  # Mantiene la proporción y nunca amplía la imagen
+                if miniatura.mode not in ("RGB", "RGBA"):
+                    miniatura = miniatura.convert("RGBA")
+                for formato, destino in formatos.items():
+                    temporal = _archivo(destino) + ".tmp"
+                    miniatura.save(temporal, FORMATOS[formato])
+                    os.replace(temporal, _archivo(destino))  # Nunca se sirve una miniatura a medio escribir
+        _guarda_variantes(ruta, variantes)
+    except Exception:  # La categoría sigue mostrando la imagen original
+        _log.exception("No se han podido generar las miniaturas de %s", ruta)
+
+
+def _guarda_variantes(ruta, variantes):
+    sesion = db.Session()  # Sesión propia, este hilo no atiende ninguna petición
+    try:
+        sesion.execute(update(Categoria).where(Categoria.imagen == ruta).values(variantes=json.dumps(variantes)))
+        sesion.commit()
+    finally:
+        sesion.close()
@@ -0,0 +1,116 @@
+import csv
+from datetime import date
+from itertools import islice
+from sqlalchemy import insert
+import libro_mayor
+from models import Productos, Proveedor, Categoria
+
+LOTE = 1000  # Filas que se insertan en cada INSERT y se guardan en cada commit
+COLUMNAS = {  # Columnas de cada tipo de CSV y su longitud máxima (None si es un número)
+    "productos": {"categoria": 30, "marca": 20, "modelo": 20, "descripcion": 200, "proveedor": 20,
+                  "precio_compra": None, "precio_venta": None, "iva": None, "cantidad_max": None, "stock": None},
+    "proveedores": {"empresa": 20, "cif": 20, "telefono": 20, "email": 100, "direccion": 100, "poblacion": 50,
+                    "provincia": 50},
+}
+
+
+def importa(sesion, tipo, texto, errores):  # Importa un CSV de productos o proveedores y devuelve (importadas, con error)
+    # texto es el CSV abierto en modo texto, que se lee por lotes sin cargarlo entero en memoria. Las filas con
+    # errores no se importan y se escriben en errores (un archivo de texto) con su número de línea y el motivo
+    filas = _lee(texto)
+    salida = csv.writer(errores)
+    salida.writerow(["linea", "error"] + list(COLUMNAS[tipo]))
+    importadas = con_error = 0
+    if tipo == "productos":  # Un solo diccionario con el id de cada proveedor y otro con las categorías
+        proveedores = dict(Proveedor.activos(sesion).with_entities(Proveedor.empresa, Proveedor.id))
+        categorias = {nombre for nombre, in Categoria.activos(sesion).with_entities(Categoria.nombre)}
+    else:
+        proveedores = {empresa for empresa, in Proveedor.activos(sesion).with_entities(Proveedor.empresa)}
+    while True:
+        lote = list(islice(filas, LOTE))
+        if len(lote) == 0:
+            return importadas, con_error
+        validas = []
+        for linea, fila in lote:
+            try:
+                if tipo == "productos":
+                    validas.append(_producto(fila, proveedores, categorias))
+                else:
+                    validas.append(_proveedor(fila, proveedores))
+            except ValueError as error:
+                salida.writerow([linea, str(error)] + [fila.get(columna, "") for columna in COLUMNAS[tipo]])
+                con_error += 1
+        if tipo == "productos":
+            _inserta_productos(sesion, validas)
+        elif len(validas) > 0:
+            sesion.execute(insert(Proveedor), validas)
+        sesion.commit()
+        importadas += len(validas)
+
+
+def _lee(texto):  # Devuelve (número de línea, fila) de cada fila del CSV, separado por comas o por punto y coma
+    cabecera = texto.readline()
+    separador = ";" if cabecera.count(";") > cabecera.count(",") else ","
+    columnas = [columna.strip().lower() for columna in next(csv.reader([cabecera], delimiter=separador), [])]
+    lector = csv.DictReader(texto, fieldnames=columnas, delimiter=separador)
+    for fila in lector:
+        yield lector.line_num + 1, fila  # La cabecera ya la hemos leído
+
+
+def _texto(fila, columna, longitud):
+    valor = (fila.get(columna) or "").strip()
+    if valor == "":
+        raise ValueError("Falta {}".format(columna))
+    if len(valor) > longitud:
+        raise ValueError("{} tiene más de {} caracteres".format(columna, longitud))
+    return valor
+
+
+def _numero(fila, columna, tipo=float):  # Admite la coma decimal de los CSV en español
+    try:
+        valor = tipo((fila.get(columna) or "").strip().replace(",", "."))
+    except ValueError:
+        raise ValueError("{} no es un número válido".format(columna))
+    if valor < 0:
+        raise ValueError("{} no puede ser negativo".format(columna))
+    return valor
+
+
+def _producto(fila, proveedores, categorias):  # Valida una fila de productos y devuelve sus valores
+    datos = {columna: _texto(fila, columna, longitud) for columna, longitud in COLUMNAS["productos"].items()
+             if longitud is not None}
+    if datos["categoria"] not in categorias:
+        raise ValueError("No existe la categoría {}".format(datos["categoria"]))
+    if datos["proveedor"] not in proveedores:
+        raise ValueError("No existe el proveedor {}".format(datos["proveedor"]))
+    producto = {"categoria": datos["categoria"], "marca": datos["marca"], "modelo": datos["modelo"],
+                "descripcion": datos["descripcion"], "id_proveedor": proveedores[datos["proveedor"]],
+                "precio_compra": _numero(fila, "precio_compra"), "precio_venta": _numero(fila, "precio_venta"),
+                "iva": _numero(fila, "iva", int), "cantidad_max": _numero(fila, "cantidad_max", int),
+                "stock": _numero(fila, "stock", int), "eliminado": 0}
+    # El mismo cálculo que Productos.__init__
+    producto["precio_final"] = producto["precio_venta"] + producto["precio_venta"] * producto["iva"] / 100
+    return producto
+
+
+def _proveedor(fila, proveedores):  # Valida una fila de proveedores y devuelve sus valores
+    proveedor = {columna: _texto(fila, columna, longitud) for columna, longitud in COLUMNAS["proveedores"].items()}
+    if proveedor["empresa"] in proveedores:
+        raise ValueError("Ya existe el proveedor {}".format(proveedor["empresa"]))
+    proveedores.add(proveedor["empresa"])  # Así tampoco se repite dentro del mismo CSV
+    proveedor.update({"antiguedad": date.today(), "eliminado": 0})
+    return proveedor
+
+
+def _inserta_productos(sesion, productos):  # Inserta un lote de productos y la compra de su stock en contabilidad
+    if len(productos) == 0:
+        return
+    if sesion.get_bind().dialect.insert_executemany_returning:  # Un INSERT para todo el lote que devuelve los ids
+        ids = sesion.execute(insert(Productos).returning(Productos.id, sort_by_parameter_order=True),
+                             productos).scalars().all()
+    else:
+        ids = [sesion.execute(insert(Productos).values(**producto)).inserted_primary_key[0] for producto in productos]
+    libro_mayor.registra_varios(sesion, [
+        {"id_producto": id_producto, "id_cliente": None, "id_proveedor": producto["id_proveedor"],
+         "cantidad": producto["stock"], "importe": -(producto["precio_compra"] * producto["stock"]), "gasto": 0}
+        for id_producto, producto in zip(ids, productos)])
@@ -0,0 +1,97 @@
+from datetime import date
+from sqlalchemy import update, delete, insert, select, func, extract, literal, desc
+import db
+from models import Contabilidad, ContabilidadMensual, Factura, FacturaLinea, Saldo
+
+TIENDA = 0  # id_cliente del resumen mensual de toda la tienda
+SALDO = 1  # id de la única fila de la tabla saldo
+
+
+def registra(sesion, movimiento, importe, gasto=0):  # Añade un movimiento de contabilidad y devuelve el nuevo beneficio
+    # importe es lo que el movimiento suma al beneficio (negativo si es una compra a un proveedor) y gasto lo que paga
+    # el cliente por él. Todo se hace en la transacción de la sesión, así que el saldo y el resumen mensual se guardan
+    # en el mismo commit que el movimiento
+    movimiento.beneficio = anota(sesion, importe)
+    sesion.add(movimiento)
+    anyo, mes = movimiento.fecha.year, movimiento.fecha.month
+    _acumula(sesion, anyo, mes, TIENDA, beneficio=movimiento.beneficio)
+    if movimiento.id_cliente is not None:
+        _acumula(sesion, anyo, mes, movimiento.id_cliente, gasto=gasto)
+    return movimiento.beneficio
+
+
+def registra_varios(sesion, movimientos):  # Añade varios movimientos de una vez y devuelve el beneficio final
+    # movimientos es una lista de diccionarios con id_producto, id_cliente, id_proveedor, cantidad, importe y gasto.
+    # El saldo se actualiza una sola vez con la suma de los importes y los movimientos se insertan en un solo INSERT
+    if len(movimientos) == 0:
+        return None
+    total = sum(m["importe"] for m in movimientos)
+    beneficio = anota(sesion, total) - total  # Beneficio antes del primer movimiento
+    hoy = date.today()
+    filas = []
+    gastos = {}  # Lo que ha gastado cada cliente en estos movimientos
+    for m in movimientos:
+        beneficio += m["importe"]
+        filas.append({"id_producto": m["id_producto"], "id_cliente": m["id_cliente"], "id_proveedor": m["id_proveedor"],
+                      "cantidad": m["cantidad"], "fecha": hoy, "beneficio": beneficio})
+        if m["id_cliente"] is not None:
+            gastos[m["id_cliente"]] = gastos.get(m["id_cliente"], 0) + m.get("gasto", 0)
+    sesion.execute(insert(Contabilidad), filas)
+    _acumula(sesion, hoy.year, hoy.month, TIENDA, beneficio=beneficio)
+    for id_cliente, gasto in gastos.items():
+        _acumula(sesion, hoy.year, hoy.month, id_cliente, gasto=gasto)
+    return beneficio
+
+
+def anota(sesion, importe):  # Suma el importe al saldo de la tienda y devuelve el nuevo beneficio
+    # La suma la hace la base de datos en un solo UPDATE, que bloquea la fila hasta el commit, así dos
+    # movimientos a la vez nunca parten del mismo beneficio
+    consulta = update(Saldo).where(Saldo.id == SALDO).values(beneficio=Saldo.beneficio + importe).execution_options(
+        synchronize_session=False)
+
+    def actualiza():
+        if sesion.get_bind().dialect.update_returning:
+            return sesion.execute(consulta.returning(Saldo.beneficio)).scalar()
+        if sesion.execute(consulta).rowcount > 0:
+            return sesion.execute(select(Saldo.beneficio).where(Saldo.id == SALDO)).scalar()
+        return None
+
+    def crea():  # Todavía no hay saldo, así que lo creamos a partir del último movimiento de contabilidad
+        ultimo = sesion.execute(select(Contabilidad.beneficio).order_by(desc(Contabilidad.id)).limit(1)).scalar()
+        sesion.add(Saldo(beneficio=(ultimo or 0) + importe, id=SALDO))
+        return (ultimo or 0) + importe
+
+    return db.actualiza_o_crea(sesion, actualiza, crea)
+
+
+def _acumula(sesion, anyo, mes, id_cliente, beneficio=None, gasto=0):  # Actualiza o crea una fila del resumen
+    valores = {"gasto": ContabilidadMensual.gasto + gasto}  # La suma la hace la base de datos, así no se pierde nada
+    if beneficio is not None:
+        valores["beneficio"] = beneficio
+    consulta = update(ContabilidadMensual).where(ContabilidadMensual.anyo == anyo, ContabilidadMensual.mes == mes,
+                                                 ContabilidadMensual.id_cliente == id_cliente).values(**valores)
+    db.actualiza_o_crea(sesion, lambda: sesion.execute(consulta).rowcount or None,
+                        lambda: sesion.add(ContabilidadMensual(anyo, mes, id_cliente, beneficio or 0, gasto)))
+
+
+def reconstruye(sesion):  # Vuelve a calcular el resumen mensual a partir de la contabilidad y las facturas
+    anyo = extract("year", Contabilidad.fecha)
+    mes = extract("month", Contabilidad.fecha)
+    sesion.execute(delete(ContabilidadMensual))
+
+    # Resumen de la tienda: el beneficio del último movimiento de cada mes
+    ultimos = select(anyo.label("anyo"), mes.label("mes"), func.max(Contabilidad.id).label("id")).group_by(
+        anyo, mes).subquery()
+    sesion.execute(insert(ContabilidadMensual).from_select(
+        ["anyo", "mes", "id_cliente", "beneficio", "gasto"],
+        select(ultimos.c.anyo, ultimos.c.mes, literal(TIENDA), Contabilidad.beneficio, literal(0.0)).join(
+            Contabilidad, Contabilidad.id == ultimos.c.id)))
+
+    # Resumen de cada cliente: lo que ha gastado cada mes, con los precios de las líneas de sus facturas (los que
+    # tenían los productos al facturar, los mismos que guardó registra_varios)
+    anyo = extract("year", Factura.fecha)
+    mes = extract("month", Factura.fecha)
+    sesion.execute(insert(ContabilidadMensual).from_select(
+        ["anyo", "mes", "id_cliente", "beneficio", "gasto"],
+        select(anyo, mes, Factura.id_cliente, literal(0.0), func.sum(FacturaLinea.precio_final)).join(
+            FacturaLinea, FacturaLinea.id_factura == Factura.id).group_by(anyo, mes, Factura.id_cliente)))
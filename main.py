@@ -1,17 +1,32 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, abort, Response, \
+    stream_with_context
 import db
-from models import Usuario, Categoria, Proveedor, Productos, Factura, Pedido, RegistrationForm, Contabilidad
-from PIL import Image  # Libreria para edición de imagenes en Python
+from models import Usuario, Categoria, Proveedor, Productos, Factura, Pedido, RegistrationForm, Contabilidad, \
+    ContabilidadMensual, FacturaLinea, PedidoLinea
+import contextlib
+from datetime import date
+import io
 import json
+import sys
+import tempfile
+import click
 from flask_login import LoginManager, login_user, login_required, logout_user  # Para trabajar con sesiones
 from werkzeug.security import generate_password_hash  # Genera claves encriptada
 from flask_wtf.csrf import CSRFProtect  # Protege al servidor cuando el usuario no ha sido auteticado
-import seaborn as sns
-import matplotlib.pyplot as plt
-import pandas as pd
-from pandas import DataFrame
-from sqlalchemy import desc
-import calendar
+import identidades  # Caché de los usuarios logueados
+import migraciones  # Cambios en la estructura y los datos de la base de datos
+import libro_mayor  # Guarda los movimientos de contabilidad y su resumen mensual
+import graficos  # Dibuja y guarda en caché las gráficas de estadísticas
+import paginacion  # Divide los listados largos en páginas
+import almacen  # Reserva el stock de los pedidos
+import imagenes  # Guarda las imágenes de las categorías y genera sus miniaturas
+import estaticos  # Huellas y cabeceras de caché de los archivos estáticos
+import busqueda  # Búsqueda de texto completo en los productos
+import importacion  # Importa productos y proveedores desde CSV
+import exportacion  # Exporta facturas, pedidos y contabilidad a CSV
+from sqlalchemy import desc, exists, func
+from sqlalchemy.exc import IntegrityError
+from concurrent.futures import TimeoutError
 
 app = Flask(__name__)
 csrf = CSRFProtect()  # Habilitamos la protección CSRF de forma global en la aplicación Flask
@@ -19,21 +34,38 @@ app.secret_key = 'MI_PROYECTO'  # Mantiene los datos seguros
 login_manager_app = LoginManager(app)  # Permite que la aplicación y Flask_Login funcionen juntos
 
 
+@app.teardown_appcontext
+def cierra_sesion_db(error):  # Al terminar cada petición devuelvo su conexión al pool y olvido sus objetos
+    db.session.remove()
+
+
+@app.url_defaults
+def huella_estaticos(endpoint, valores):  # url_for("static", ...) añade la huella del archivo (?v=) a la URL
+    if endpoint == "static" and "filename" in valores and "v" not in valores:
+        version = estaticos.huella(app.static_folder, valores["filename"])
+        if version is not None:
+            valores["v"] = version
+
+
+@app.after_request
+def cachea_estaticos(respuesta):  # Los archivos estáticos con huella se guardan en el navegador sin revalidarlos
+    if request.endpoint == "static" and respuesta.status_code in (200, 304):
+        estaticos.cabeceras(respuesta, app.static_folder, request.view_args["filename"], request.args.get("v"))
+    return respuesta
+
+
+@app.template_global()
+def estatico(ruta):  # URL con huella de una ruta guardada en la base de datos, como "../static/imagenes/1.png"
+    return url_for("static", filename=ruta.split("static/", 1)[-1])
+
+
 @app.route("/")
 def home():
     if session == {}:  # Si no hay ningún usuario logueado
         session['admin'] = None
 
-    productos = db.session.query(Productos).all()
-    categorias_sin_eliminar = []
-    prod_escasos = []
-    for producto in productos:  # Compruebo si los stocks de los productos están por debajo del 90%
-        if producto.stock < producto.cantidad_max * 0.9:
-            prod_escasos.append(producto)
-    categorias = db.session.query(Categoria).all()
-    for i in categorias:
-        if i.eliminado == 0:
-            categorias_sin_eliminar.append(i)
+    prod_escasos = Productos.escasos(db.session).order_by(Productos.id).all()  # Stock por debajo del 90%
+    categorias_sin_eliminar = Categoria.activos(db.session).all()
     return render_template("index.html", prod_escasos=prod_escasos, categorias=categorias_sin_eliminar,
                            cierra_sesion="Cerrar Sesión")
 
@@ -41,19 +73,19 @@ def home():
 # ----------------------USUARIOS---------------------------------------
 
 @login_manager_app.user_loader
-def load_user(id):  # Carga el usuario que se loguea
-    return db.session.query(Usuario).filter_by(id=id).first()
+def load_user(id):  # Carga el usuario que se loguea, desde la caché de usuarios si es posible
+    return identidades.carga(db.session, id)
 
 
 @app.route("/usuarios")
 def usuarios():  # Carga una lista con todos los usuarios
-    usuarios = db.session.query(Usuario).all()
-    usuarios_sin_eliminar = []
-    for i in usuarios:
-        if i.eliminado == 0:
-            usuarios_sin_eliminar.append(i)
+    return muestra_usuarios()
+
+
+def muestra_usuarios():  # Muestra una página de la lista de usuarios
+    usuarios_sin_eliminar, siguiente = paginacion.pagina(Usuario.activos(db.session), [Usuario.id])
     return render_template("usuarios.html", usuarios=usuarios_sin_eliminar, cierra_sesion="Cerrar Sesión",
-                           eliminado=False)
+                           eliminado=False, siguiente=siguiente)
 
 
 @app.route("/registro")
@@ -75,7 +107,12 @@ def crear_usuario():  # Crea usuarios nuevos
                           generate_password_hash(form.contrasenia.data), form.nombre.data,
                           form.apellido.data, form.direccion.data, form.poblacion.data, form.provincia.data)
         db.session.add(usuario)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:  # Ya hay un usuario activo con ese email
+            db.session.rollback()
+            flash('Ya existe un usuario con ese email')
+            return render_template('formulario.html', form=form)
         flash('Usuario registrado correctamente')  # Flash viene con la libreria flask y manda mensajes por pantalla
         return render_template('registro.html')
     return render_template('formulario.html',
@@ -86,21 +123,20 @@ def crear_usuario():  # Crea usuarios nuevos
 def comprueba_usuario():  # Comprueba si el usuario y la contraseña se encuentran en la base de datos
     email = request.form["email"]
     contrasenia = request.form["contrasenia"]
-    todos_los_usuarios = db.session.query(Usuario).all()
-    for i in todos_los_usuarios:
-        if i.email == email and i.eliminado == 0:
-            if (i.check_contrasenia(i.contrasenia,
-                                    contrasenia)):  # Comprobamos que la contraseña encriptada coincide con la introducida por el usuario
-                session['id'] = i.id  # Creamos una sesión con el id del usuario
-                usuario_logueado = db.session.query(Usuario).filter_by(id=i.id).first()
-                login_user(usuario_logueado)  # Cargamos el usuario logueado
-                session['usuario'] = i.usuario  # Almacenamos en la sesión el nombre del usuario
-                session[
-                    'admin'] = i.admin  # Almacenamos en la sesión el tipo de usuario (administrador, usuario o invitado)
-                return redirect(url_for("home"))
-            else:
-                flash("Contraseña incorrecta")  # Enviamos un mensaje si la contraseña es incorrecta
-                return render_template("registro.html")
+    usuario = Usuario.activos(db.session).filter_by(
+        email=email).first()  # Usa el índice de emails de usuarios activos
+    if usuario is not None:
+        if (usuario.check_contrasenia(usuario.contrasenia,
+                                      contrasenia)):  # Comprobamos que la contraseña encriptada coincide con la introducida por el usuario
+            session['id'] = usuario.id  # Creamos una sesión con el id del usuario
+            login_user(usuario)  # Cargamos el usuario logueado
+            session['usuario'] = usuario.usuario  # Almacenamos en la sesión el nombre del usuario
+            session[
+                'admin'] = usuario.admin  # Almacenamos en la sesión el tipo de usuario (administrador, usuario o invitado)
+            return redirect(url_for("home"))
+        else:
+            flash("Contraseña incorrecta")  # Enviamos un mensaje si la contraseña es incorrecta
+            return render_template("registro.html")
     flash("Usuario no encontrado")  # Enviamos un mensaje si el usuario no se encuentra en la base de datos
     return render_template("registro.html")
 
@@ -111,17 +147,14 @@ def eliminar_usuario(id):  # Elimina un usuario por su id
     usuario_eliminar = db.session.query(Usuario).filter_by(id=int(id))
     usuario_eliminar.first().eliminado = 1
     db.session.commit()
-    usuarios = db.session.query(Usuario).all()
-    usuarios_sin_eliminar = []
-    for i in usuarios:
-        if i.eliminado == 0:
-            usuarios_sin_eliminar.append(i)
-    return render_template("usuarios.html", usuarios=usuarios_sin_eliminar, cierra_sesion="Cerrar Sesión",
-                           eliminado=False)
+    identidades.olvida(id)  # Así no sigue logueado aunque esté en la caché
+    return muestra_usuarios()
 
 
 @app.route("/reinicia_conecta")
 def reinicia_conecta():  # Reinicia la sesión a modo invitado
+    if 'id' in session:
+        identidades.olvida(session['id'])  # Lo quito de la caché de usuarios
     logout_user()  # Cierro sesión de usuario logueado
     session.clear()  # Libero la sesión
     return redirect(url_for("home"))
@@ -132,11 +165,7 @@ def reinicia_conecta():  # Reinicia la sesión a modo invitado
 @app.route("/categorias")
 @login_required  # Solo pueden acceder los usuarios registrados
 def categorias():
-    categorias = db.session.query(Categoria).all()
-    categorias_sin_eliminar = []
-    for i in categorias:
-        if i.eliminado == 0:
-            categorias_sin_eliminar.append(i)
+    categorias_sin_eliminar = Categoria.activos(db.session).all()
     return render_template("categorias.html", categorias=categorias_sin_eliminar, cierra_sesion="Cerrar Sesión")
 
 
@@ -149,70 +178,71 @@ def crea_categorias():  # Nos redirecciona a la pagina crea_categorias.html
 @app.route("/crea_categoria", methods=["POST"])
 @login_required  # Solo pueden acceder los usuarios registrados
 def crea_categoria():  # Crea una categoría nueva
-    imagen = request.files["imagen"]  # Recibimos un archivo de formato imagen
-    img = Image.open(imagen)  # Abre e identifica el archivo proporcionado
-    todas_categorias = db.session.query(Categoria).all()
-    nombre_imagen = str(len(todas_categorias))  # Le ponemos nombre a la imagen que coincide con el número de categorías
-    nombre_imagen = nombre_imagen + ".png"  # Es necesario ponerle extensión a la imagen
-    img.save("static/imagenes/" + nombre_imagen)  # Guardamos la imagen en su carpeta
-    categoria = Categoria(nombre=request.form["nombre"],
-                          imagen="../static/imagenes/" + nombre_imagen)  # Creamos un objeto de la clase Categoria
+    imagen = imagenes.recibe(request.files["imagen"])  # Guardamos la imagen en su carpeta, con su hash como nombre
+    if imagen is None:
+        flash("El archivo no es una imagen PNG, JPEG, GIF o WebP")
+        return redirect(url_for("crea_categorias"))
+    categoria = Categoria(nombre=request.form["nombre"], imagen=imagen)  # Creamos un objeto de la clase Categoria
     db.session.add(categoria)  # guarda los datos del formulario en la base de datos
     db.session.commit()
+    imagenes.encarga_miniaturas(imagen)  # Las miniaturas se generan después de responder
     return redirect(url_for("home"))
 
 
 @app.route("/eliminar_categoria/<nombre>")
 @login_required  # Solo pueden acceder los usuarios registrados
 def eliminar_categoria(nombre):  # Eliminamos una categoría dado el nombre de la categoría
-    productos = db.session.query(Productos).filter_by(categoria=nombre)
-    categoria = db.session.query(Categoria).filter_by(nombre=nombre)  # filtra el elemento que vamos a eliminar
-    for i in productos:  # Los productos dependen de las categorías, así que si eliminamos una categoría se eliminan todos los productos que le pertenecen
-        i.eliminado = 1
-    categoria.first().eliminado = 1
+    # Los productos dependen de las categorías, así que si eliminamos una categoría se eliminan todos los productos que
+    # le pertenecen. Cada tabla se actualiza con un solo UPDATE, sin cargar los productos
+    Productos.activos(db.session).filter_by(categoria=nombre).update({"eliminado": 1}, synchronize_session=False)
+    Categoria.activos(db.session).filter_by(nombre=nombre).update({"eliminado": 1}, synchronize_session=False)
     db.session.commit()
-    categorias = db.session.query(Categoria).all()
-    categorias_sin_eliminar = []
-    for i in categorias:
-        if i.eliminado == 0:
-            categorias_sin_eliminar.append(i)
-    return render_template("categorias.html", categorias=categorias_sin_eliminar, cierra_sesion="Cerrar Sesión")
+    return redirect(url_for("categorias"))
 
 
 # ----------------------PRODUCTOS---------------------------------------
 
 @app.route("/productos")
 def productos():  # Nos redirecciona a productos.html
-    productos = db.session.query(Productos).order_by("categoria").all()
-    productos_sin_eliminar = []
-    for i in productos:
-        if i.eliminado == 0:
-            productos_sin_eliminar.append(i)
-    return render_template("productos.html", productos=productos_sin_eliminar, cierra_sesion="Cerrar Sesión",
-                           eliminado=False)
+    return muestra_productos(eliminado=False)
 
 
 @app.route("/filtra_productos/<nombre>")
 def filtra_productos(nombre):
-    productos = db.session.query(Productos).filter_by(categoria=nombre)
-    productos_sin_eliminar = []
-    for i in productos:
-        if i.eliminado == 0:
-            productos_sin_eliminar.append(i)
+    return muestra_productos(eliminado=True, categoria=nombre)
+
+
+@app.route("/buscar")
+def buscar():  # Busca productos por su marca, modelo y descripción, de más a menos relevante
+    texto = request.args.get("q", "")
+    categoria = request.args.get("categoria") or None  # Opcionalmente solo en una categoría
+    productos_encontrados, siguiente = [], None
+    if len(busqueda.palabras(texto)) > 0:
+        consulta, columnas = busqueda.busca(db.session, texto, categoria)
+        filas, siguiente = paginacion.pagina(consulta, columnas)
+        productos_encontrados = [fila[0] for fila in filas]  # Cada fila es el producto y su relevancia
+    return render_template("productos.html", productos=productos_encontrados, cierra_sesion="Cerrar Sesión",
+                           eliminado=True, categoria=categoria, busqueda=texto, siguiente=siguiente)
+
+
+def muestra_productos(eliminado, categoria=None):  # Muestra una página de productos, ordenados por categoría
+    productos_sin_eliminar = Productos.activos(db.session)
+    if categoria is not None:
+        productos_sin_eliminar = productos_sin_eliminar.filter_by(categoria=categoria)
+    # El índice ix_producto_categoria_activo ya está en este orden, así que cada página se lee directamente de él
+    productos_sin_eliminar, siguiente = paginacion.pagina(productos_sin_eliminar, [Productos.categoria, Productos.id])
+    if categoria is None:
+        return render_template("productos.html", productos=productos_sin_eliminar, cierra_sesion="Cerrar Sesión",
+                               eliminado=eliminado, siguiente=siguiente)
     return render_template("productos.html", productos=productos_sin_eliminar, cierra_sesion="Cerrar Sesión",
-                           eliminado=True,
-                           categoria=nombre)
+                           eliminado=eliminado, categoria=categoria, siguiente=siguiente)
 
 
 @app.route("/crea_producto/<id>")
 @login_required  # Solo pueden acceder los usuarios registrados
 def crea_producto(id):
-    categorias = db.session.query(Categoria).all()
-    proveedores = db.session.query(Proveedor).all()
-    proveedores_sin_eliminar = []
-    for i in proveedores:
-        if i.eliminado == 0:
-            proveedores_sin_eliminar.append(i)
+    categorias = Categoria.activos(db.session).all()
+    proveedores_sin_eliminar = Proveedor.activos(db.session).all()
 
     if id == "None":  # Si creamos un producto nuevo
         producto = Productos()  # Si vamos a crear un producto nuevo, enviamos un objeto vacío
@@ -226,10 +256,8 @@ def crea_producto(id):
 @app.route("/crear-producto", methods=["POST"])
 @login_required  # Solo pueden acceder los usuarios registrados
 def crear_producto():  # Recoge los datos del formulario crea_producto.html y lo almacena en la base de datos
-    proveedor = db.session.query(Proveedor).filter_by(
+    proveedor = Proveedor.activos(db.session).filter_by(
         empresa=request.form["proveedor"]).first()  # Del formulario recibo el nombre del proveedor y busco el id
-    beneficio = db.session.query(Contabilidad).order_by(
-        desc(Contabilidad.id)).first()  # Busco el últimpo movimiento de contabiliadad
     producto = Productos(categoria=request.form["categoria"], marca=request.form["marca"],
                          modelo=request.form["modelo"],
                          descripcion=request.form["descripcion"], id_proveedor=proveedor.id,
@@ -238,27 +266,20 @@ def crear_producto():  # Recoge los datos del formulario crea_producto.html y lo
                          cantidad_max=request.form["cantidad_max"],
                          stock=request.form["stock"])
     db.session.add(producto)  # Alamaceno el nuevo producto
-    db.session.commit()
+    db.session.flush()  # Así ya tenemos su id, el producto y su compra se guardan en el mismo commit
 
-    producto = db.session.query(Productos).order_by(desc(Productos.id)).first()
     contabilidad = Contabilidad(id_producto=producto.id, id_cliente=None, id_proveedor=proveedor.id,
-                                cantidad=producto.stock,
-                                beneficio=beneficio.beneficio - (float(producto.precio_compra) * int(producto.stock)))
-    db.session.add(contabilidad)  # Almaceno un nuevo campo en contabilidad con lo que me ha costado el nuevo producto
+                                cantidad=int(producto.stock))
+    libro_mayor.registra(db.session, contabilidad, -(float(producto.precio_compra) * int(
+        producto.stock)))  # Almaceno un nuevo campo en contabilidad con lo que me ha costado el nuevo producto
     db.session.commit()
 
-    productos = db.session.query(Productos).order_by("categoria").all()
-    productos_sin_eliminar = []
-    for i in productos:
-        if i.eliminado == 0:
-            productos_sin_eliminar.append(i)
-    return render_template("productos.html", productos=productos_sin_eliminar, cierra_sesion="Cerrar Sesión",
-                           eliminado=True)
+    return muestra_productos(eliminado=True)
 
 
 @app.route("/editar-producto/<id>", methods=["POST"])
 def editar_producto(id):  # Recoge los datos del formulario crea_producto.html y edita los campos que hemos modificado
-    proveedor = db.session.query(Proveedor).filter_by(empresa=request.form["proveedor"]).first()
+    proveedor = Proveedor.activos(db.session).filter_by(empresa=request.form["proveedor"]).first()
 
     # Recojo los datos nuevos
     producto = Productos(categoria=request.form["categoria"], marca=request.form["marca"],
@@ -282,54 +303,32 @@ def editar_producto(id):  # Recoge los datos del formulario crea_producto.html y
     producto_editado.precio_compra = producto.precio_compra
     producto_editado.precio_venta = producto.precio_venta
     producto_editado.iva = producto.iva
+    producto_editado.precio_final = producto.precio_final  # Productos() lo calcula con el precio de venta y el IVA
     producto_editado.cantidad_max = producto.cantidad_max
     producto_editado.stock = producto.stock
 
-    beneficio = db.session.query(Contabilidad).order_by(desc(
-        Contabilidad.id)).first()  # Busco el último elementeo de contabilidad para modificarlo según la nueva entrada
     contabilidad = Contabilidad(id_producto=id, id_cliente=None, id_proveedor=proveedor.id,
-                                cantidad=int(producto.stock) - int(request.form["stock_antiquo"]),
-                                beneficio=beneficio.beneficio - (
-                                        (int(producto.stock) - int(request.form["stock_antiquo"])) * float(
-                                    producto_editado.precio_compra)))
+                                cantidad=int(producto.stock) - int(request.form["stock_antiquo"]))
     if contabilidad.cantidad > 0:  # Si se modifica el stock del producto se tiene que sumar en la contabilidad
-        db.session.add(contabilidad)
+        libro_mayor.registra(db.session, contabilidad, -(contabilidad.cantidad * float(producto_editado.precio_compra)))
+    graficos.cambia_datos(db.session)  # Los precios pueden haber cambiado sin ningún movimiento de contabilidad
     db.session.commit()
-    productos = db.session.query(Productos).order_by("categoria").all()
-    productos_sin_eliminar = []
-    for i in productos:
-        if i.eliminado == 0:
-            productos_sin_eliminar.append(i)
-    return render_template("productos.html", productos=productos_sin_eliminar, cierra_sesion="Cerrar Sesión",
-                           eliminado=False)
+    return muestra_productos(eliminado=False)
 
 
 @app.route("/eliminar_producto/<id>")
 @login_required  # Solo pueden acceder los usuarios registrados
 def eliminar_producto(id):
     producto = db.session.query(Productos).filter_by(id=int(id))  # filtra el elemento que vamos a eliminar
-    pedidos = db.session.query(Pedido)
-
-    for pedido in pedidos.all():  # Elimina los productos eliminados de los pedidos
-        pedidos_json = json.loads(pedido.pedido)
-        if len(pedidos_json) == 1 and pedidos_json[0][0] == id:
-            eliminar_pedido(pedidos[0].id)
-        else:
-            for prod in pedidos_json:
-                if prod[0] == id:
-                    pedidos_json.remove(prod)
-                    pedido_rectificado = json.dumps(pedidos_json)
-                    pedido.pedido = pedido_rectificado
+    # Quito el producto de todos los pedidos y borro los pedidos que se quedan vacíos
+    ids_pedidos = [fila.id_pedido for fila in db.session.query(PedidoLinea.id_pedido).filter_by(id_producto=int(id))]
+    db.session.query(PedidoLinea).filter_by(id_producto=int(id)).delete(synchronize_session=False)
+    db.session.query(Pedido).filter(Pedido.id.in_(ids_pedidos), ~exists().where(
+        PedidoLinea.id_pedido == Pedido.id)).delete(synchronize_session=False)
 
     producto.first().eliminado = 1
     db.session.commit()
-    productos = db.session.query(Productos).all()
-    productos_sin_eliminar = []
-    for i in productos:
-        if i.eliminado == 0:
-            productos_sin_eliminar.append(i)
-    return render_template("productos.html", productos=productos_sin_eliminar, cierra_sesion="Cerrar Sesión",
-                           eliminado=False)
+    return muestra_productos(eliminado=False)
 
 
 # ----------------------PROVEEDORES---------------------------------------
@@ -337,12 +336,13 @@ def eliminar_producto(id):
 @app.route("/proveedores")
 @login_required  # Solo pueden acceder los usuarios registrados
 def proveedores():
-    proveedores = db.session.query(Proveedor).all()
-    proveedores_sin_eliminar = []
-    for i in proveedores:
-        if i.eliminado == 0:
-            proveedores_sin_eliminar.append(i)
-    return render_template("proveedores.html", proveedores=proveedores_sin_eliminar, cierra_sesion="Cerrar Sesión")
+    return muestra_proveedores()
+
+
+def muestra_proveedores():  # Muestra una página de la lista de proveedores
+    proveedores_sin_eliminar, siguiente = paginacion.pagina(Proveedor.activos(db.session), [Proveedor.id])
+    return render_template("proveedores.html", proveedores=proveedores_sin_eliminar, cierra_sesion="Cerrar Sesión",
+                           siguiente=siguiente)
 
 
 @app.route("/registro_proveedores")
@@ -360,35 +360,42 @@ def crea_proveedor():
 @app.route("/crear-proveedor", methods=["POST"])  # Conecta el html con python
 @login_required  # Solo pueden acceder los usuarios registrados
 def crear_proveedor():  # Recoge los datos del formulario de index.html
-    proveedores_sin_eliminar = []
     proveedor = Proveedor(empresa=request.form["empresa"], cif=request.form["cif"], telefono=request.form["telefono"],
                           email=request.form["email"], direccion=request.form["direccion"],
                           poblacion=request.form["poblacion"], provincia=request.form["provincia"])
 
     db.session.add(proveedor)  # guarda los datos del formulario en la base de datos
     db.session.commit()
-    proveedores = db.session.query(Proveedor).all()
-    for i in proveedores:
-        if i.eliminado == 0:
-            proveedores_sin_eliminar.append(i)
-    return render_template("proveedores.html", proveedores=proveedores_sin_eliminar, cierra_sesion="Cerrar Sesión")
+    return muestra_proveedores()
 
 
 @app.route("/eliminar_proveedor/<id>")
 @login_required  # Solo pueden acceder los usuarios registrados
 def eliminar_proveedor(id):
-    productos = db.session.query(Productos).filter_by(id_proveedor=id)
-    proveedor = db.session.query(Proveedor).filter_by(id=id)  # filtra el elemento que vamos a eliminar
-    proveedores_sin_eliminar = []
-    for i in productos:
-        i.eliminado = 1
-    proveedor.first().eliminado = 1
+    # Elimino el proveedor y todos sus productos con un UPDATE para cada tabla
+    Productos.activos(db.session).filter_by(id_proveedor=int(id)).update({"eliminado": 1}, synchronize_session=False)
+    Proveedor.activos(db.session).filter_by(id=int(id)).update({"eliminado": 1}, synchronize_session=False)
     db.session.commit()
-    proveedores = db.session.query(Proveedor).all()
-    for i in proveedores:
-        if i.eliminado == 0:
-            proveedores_sin_eliminar.append(i)
-    return render_template("proveedores.html", proveedores=proveedores_sin_eliminar, cierra_sesion="Cerrar Sesión")
+    return redirect(url_for("proveedores"))
+
+
+@app.route("/importar/<tipo>", methods=["POST"])
+@login_required  # Solo pueden acceder los usuarios registrados
+def importar(tipo):  # Importa un CSV de productos o de proveedores subido desde un formulario
+    if tipo not in importacion.COLUMNAS:
+        abort(404)
+    # El CSV se lee por lotes directamente de la subida y los errores se guardan en memoria o en disco si son muchos
+    texto = io.TextIOWrapper(request.files["archivo"].stream, encoding="utf-8-sig", newline="")
+    errores = tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode="w+", encoding="utf-8", newline="")
+    importadas, con_error = importacion.importa(db.session, tipo, texto, errores)
+    flash("Se han importado {} {}".format(importadas, tipo))
+    if con_error == 0:
+        errores.close()
+        return redirect(url_for(tipo))
+    flash("{} filas tienen errores y no se han importado".format(con_error))
+    errores.seek(0)  # Devuelvo el CSV de errores para que se puedan corregir y volver a importar
+    return Response(errores, mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename=errores_{}.csv".format(tipo)})
 
 
 # ----------------------PEDIDOS---------------------------------------
@@ -398,36 +405,42 @@ def eliminar_proveedor(id):
 def pedidos():
     usuario = session['id']  # Uso el id en vez del admin, para poder usarlo 4 líneas más abajo
     if usuario == 1:
-        pedidos = db.session.query(Pedido).all()
+        pedidos = db.session.query(Pedido)
     else:
         pedidos = db.session.query(Pedido).filter_by(id_cliente=int(usuario))
+    pedidos, siguiente = paginacion.pagina(pedidos, [Pedido.id])
+    # Cargo los clientes y las líneas de todos los pedidos (con sus productos) con una consulta para cada uno
+    ids_clientes = {pedido.id_cliente for pedido in pedidos}
+    clientes = dict(db.session.query(Usuario.id, Usuario.usuario).filter(Usuario.id.in_(ids_clientes)))
+    lineas = {}
+    for linea, producto in db.session.query(PedidoLinea, Productos).join(
+            Productos, Productos.id == PedidoLinea.id_producto).filter(
+            PedidoLinea.id_pedido.in_([pedido.id for pedido in pedidos])).order_by(PedidoLinea.id):
+        lineas.setdefault(linea.id_pedido, []).append((linea, producto))
     lista_todos_pedidos = []
     for pedido in pedidos:
         lista_pedidos = []
         lista_pedidos.append(pedido.id)
-        cliente = db.session.query(Usuario).filter_by(id=pedido.id_cliente)
-        lista_pedidos.append(cliente[0].usuario)
-        productos = json.loads(pedido.pedido)  # Cargo en productos la lista de los productos del pedido
+        lista_pedidos.append(clientes.get(pedido.id_cliente))
         lista_todos_productos = []
-        for producto in productos:
-            producto_pedido = db.session.query(Productos).filter_by(id=producto[0])
+        for linea, producto_pedido in lineas.get(pedido.id, []):
             lista_productos = []
-            lista_productos.append(producto_pedido[0].id)
-            lista_productos.append(producto_pedido[0].categoria)
-            lista_productos.append(producto_pedido[0].marca)
-            lista_productos.append(producto_pedido[0].modelo)
-            lista_productos.append(producto[1])
-            lista_productos.append(producto_pedido[0].precio_venta)
-            lista_productos.append(producto_pedido[0].iva)
-            precio_final = round((producto_pedido[0].iva / 100 * producto_pedido[0].precio_venta + producto_pedido[
-                0].precio_venta) * int(producto[1]), 2)
+            lista_productos.append(producto_pedido.id)
+            lista_productos.append(producto_pedido.categoria)
+            lista_productos.append(producto_pedido.marca)
+            lista_productos.append(producto_pedido.modelo)
+            lista_productos.append(linea.cantidad)
+            lista_productos.append(producto_pedido.precio_venta)
+            lista_productos.append(producto_pedido.iva)
+            precio_final = round((producto_pedido.iva / 100 * producto_pedido.precio_venta + producto_pedido.precio_venta)
+                                 * linea.cantidad, 2)
             lista_productos.append(precio_final)
             lista_todos_productos.append(lista_productos)  # Creo una lista con toda la información del producto
         lista_pedidos.append(lista_todos_productos)  # Creo una lista con las listas de información de cada producto
         lista_todos_pedidos.append(
             lista_pedidos)  # Finalmente creo una lista con la  id del pedido, el usuario y los datos de todos los productos de su pedido
     return render_template("pedidos.html", lista_todos_pedidos=lista_todos_pedidos, cierra_sesion="Cerrar Sesión",
-                           eliminado=False)
+                           eliminado=False, siguiente=siguiente)
 
 
 @app.route("/crear_pedido", methods=["POST"])
@@ -438,42 +451,49 @@ def crear_pedido():
     lista_cantidades = request.form.getlist(
         "cantidad")  # Recibo del formulario una lista con las cantidades de los productos que el cliente ha seleccionado
 
-    lista_pedidos = []  # Guardará los productos y las cantidades
+    pedidas = {}  # Cantidad pedida de cada producto
     for k in range(0, len(lista_productos)):
-        if lista_cantidades[k] != "0":
-            producto = db.session.query(Productos).filter_by(id=lista_productos[k]).first()
-            if producto.stock < int(lista_cantidades[k]):  # Modifico el stock del producto
-                lista_cantidades[k] = producto.stock
-                producto.stock = 0
-                flash("El producto no tiene stock suficiente, le hemos añadido el stock que nos queda")
-            else:
-                producto.stock = producto.stock - int(lista_cantidades[k])
-            lista_pedidos.append((lista_productos[k], lista_cantidades[k]))
-
-    if len(lista_pedidos) > 0:  # Compruebo que haya elegido alguna cantidad en al menos un producto
-        json_pedido = json.dumps(lista_pedidos)
-
-        pedido = Pedido(id_cliente=session['id'], pedido=json_pedido)
-        db.session.add(pedido)
-        db.session.commit()
-    else:
+        if int(lista_cantidades[k]) > 0:
+            pedidas[int(lista_productos[k])] = pedidas.get(int(lista_productos[k]), 0) + int(lista_cantidades[k])
+    if len(pedidas) == 0:  # Compruebo que haya elegido alguna cantidad en al menos un producto
         flash("Debe marcar alguna cantidad en al menos un producto")
         return redirect(url_for("productos"))
 
+    reservadas = almacen.reserva(db.session, pedidas)  # Modifico el stock de los productos
+    faltan = [id_producto for id_producto in pedidas if reservadas[id_producto] < pedidas[id_producto]]
+    for producto in db.session.query(Productos).filter(Productos.id.in_(faltan)):
+        if reservadas[producto.id] > 0:
+            flash("El producto {} {} no tiene stock suficiente, le hemos añadido las {} unidades que nos quedan".format(
+                producto.marca, producto.modelo, reservadas[producto.id]))
+        else:
+            flash("El producto {} {} no tiene stock, no se ha añadido al pedido".format(producto.marca, producto.modelo))
+
+    lista_pedidos = [(id_producto, cantidad) for id_producto, cantidad in reservadas.items() if cantidad > 0]
+    if len(lista_pedidos) == 0:  # No quedaba stock de ninguno
+        return redirect(url_for("productos"))
+    pedido = Pedido(id_cliente=session['id'])
+    db.session.add(pedido)
+    db.session.flush()  # Así ya tenemos el id del pedido para sus líneas
+    db.session.add_all([PedidoLinea(pedido.id, id_producto, cantidad) for id_producto, cantidad in lista_pedidos])
+    db.session.commit()
+
     return redirect(url_for("pedidos"))
 
 
 @app.route("/eliminar_pedido/<id>")
 @login_required  # Solo pueden acceder los usuarios registrados
 def eliminar_pedido(id):
-    pedido_json = db.session.query(Pedido).filter_by(id=id)  # Selecciono el pedido a eliminar
-    productos = db.session.query((Productos)).all()
-    pedidos = json.loads(pedido_json[0].pedido)
-    for i in pedidos:  # Repongo el stock de los productos
-        for j in productos:
-            if i[0] == str(j.id):
-                j.stock = str(int(j.stock) + int(i[1]))
-    pedido_json.delete()
+    # Si el pedido sigue en JSON, sus líneas se crean ahora para poder reponer su stock
+    migraciones.migra_pedidos(db.session, db.session.query(Pedido).filter_by(id=int(id)).all())
+    db.session.flush()
+    # Repongo el stock de los productos del pedido con un solo UPDATE, sumando las cantidades de sus líneas
+    lineas = db.session.query(PedidoLinea).filter_by(id_pedido=int(id))
+    cantidad = lineas.with_entities(func.sum(PedidoLinea.cantidad)).filter(
+        PedidoLinea.id_producto == Productos.id).scalar_subquery()
+    db.session.query(Productos).filter(Productos.id.in_(lineas.with_entities(PedidoLinea.id_producto))).update(
+        {"stock": Productos.stock + cantidad}, synchronize_session=False)
+    db.session.query(PedidoLinea).filter_by(id_pedido=int(id)).delete(synchronize_session=False)
+    db.session.query(Pedido).filter_by(id=int(id)).delete(synchronize_session=False)
     db.session.commit()
     return redirect(url_for("pedidos"))
 
@@ -484,71 +504,54 @@ def eliminar_pedido(id):
 @login_required  # Solo pueden acceder los usuarios registrados
 def facturas():
     usuario = session['id']  # Uso el id en vez del admin, para poder usarlo 4 líneas más abajo
-    if usuario == 1:
-        facturas = db.session.query(Factura).order_by(
-            desc(Factura.id)).all()  # Ordeno las facturas de más nueva a más antigua
-    else:
-        facturas = db.session.query(Factura).filter_by(id_cliente=int(usuario)).order_by(
-            desc(Factura.id))  # Ordeno las facturas de más nueva a más antigua
+    # Una consulta con la cabecera y el cliente de las facturas de la página y otra con sus líneas, que ya guardan
+    # sus precios
+    facturas = db.session.query(Factura, Usuario.usuario).join(Usuario, Usuario.id == Factura.id_cliente)
+    if usuario != 1:
+        facturas = facturas.filter(Factura.id_cliente == int(usuario))
+    # Ordeno las facturas de más nueva a más antigua
+    facturas, siguiente = paginacion.pagina(facturas, [Factura.id], descendente=True)
+    lineas = {}
+    for linea in db.session.query(FacturaLinea).filter(
+            FacturaLinea.id_factura.in_([factura.id for factura, cliente in facturas])).order_by(FacturaLinea.id):
+        lineas.setdefault(linea.id_factura, []).append([linea.id_producto, linea.categoria, linea.marca, linea.modelo,
+                                                        linea.cantidad, linea.precio_venta, linea.iva,
+                                                        linea.precio_final])
     lista_todas_facturas = []
-    for factura in facturas:
-        lista_facturas = []
-        lista_facturas.append(factura.id)  # Esto irá en la cabecera de las facturas
-        cliente = db.session.query(Usuario).filter_by(id=factura.id_cliente)
-        lista_facturas.append(cliente[0].usuario)  # # Esto irá en la cabecera de las facturas
-        productos = json.loads(factura.factura)
-        lista_todos_productos = []
-        precio_total = 0
-        for producto in productos:
-            producto_factura = db.session.query(Productos).filter_by(id=producto[0])
-            lista_productos = []
-            lista_productos.append(producto_factura[0].id)
-            lista_productos.append(producto_factura[0].categoria)
-            lista_productos.append(producto_factura[0].marca)
-            lista_productos.append(producto_factura[0].modelo)
-            lista_productos.append(producto[1])
-            lista_productos.append(producto_factura[0].precio_venta)
-            lista_productos.append(producto_factura[0].iva)
-            precio_final = round((producto_factura[0].iva / 100 * producto_factura[0].precio_venta + producto_factura[
-                0].precio_venta) * int(producto[1]), 2)
-            precio_total += precio_final
-            precio_total = round(precio_total, 2)
-            lista_productos.append(precio_final)
-            lista_todos_productos.append(lista_productos)
-
-        lista_facturas.append(precio_total)  # Esto irá en la cabecera de las facturas
-        lista_facturas.append(factura.fecha)  # Esto irá en la cabecera de las facturas
-        lista_facturas.append(lista_todos_productos)  # Esto irá en el cuerpo de la factura
-        lista_todas_facturas.append(lista_facturas)
-        lista_todas_facturas = lista_todas_facturas
-        # print(lista_todas_facturas)
+    for factura, cliente in facturas:
+        # Cabecera de la factura: id, cliente, precio total, fecha y la lista de productos (el cuerpo)
+        lista_todas_facturas.append([factura.id, cliente, factura.total, factura.fecha, lineas.get(factura.id, [])])
 
     return render_template("facturas.html", lista_todas_facturas=lista_todas_facturas,
-                           cierra_sesion="Cerrar Sesión", eliminado=False)
+                           cierra_sesion="Cerrar Sesión", eliminado=False, siguiente=siguiente)
 
 
 @app.route("/crear-factura", methods=["POST"])
 @login_required  # Solo pueden acceder los usuarios registrados
 def crear_factura():
     id_pedido = request.form['pedido']
-    pedido = db.session.query(Pedido).filter_by(id=id_pedido)
-    factura = Factura(id_cliente=pedido[0].id_cliente, factura=pedido[0].pedido)
-    id_cliente = pedido.first().id_cliente
-    pedido_json = json.loads(pedido.first().pedido)
-    for producto in pedido_json:  # Modifico la contabiliad
-        id_producto = int(producto[0])
-        producto_facturado = db.session.query(Productos).filter_by(id=id_producto).first()
-        cantidad = int(producto[1])
-        beneficio = db.session.query(Contabilidad).order_by(desc(Contabilidad.id)).first()
-        beneficio_final = beneficio.beneficio
-        contabilidad = Contabilidad(id_producto=id_producto, id_cliente=id_cliente,
-                                    id_proveedor=producto_facturado.id_proveedor, cantidad=cantidad,
-                                    beneficio=beneficio_final + (cantidad * producto_facturado.precio_final))
-        db.session.add(contabilidad)
-        db.session.commit()
+    pedido = db.session.query(Pedido).filter_by(id=id_pedido).first()
+    migraciones.migra_pedidos(db.session, [pedido])  # Si el pedido sigue en JSON, sus líneas se crean ahora
+    lineas = db.session.query(PedidoLinea).filter_by(id_pedido=pedido.id).order_by(PedidoLinea.id).all()
+    productos_facturados = {producto.id: producto for producto in db.session.query(Productos).filter(
+        Productos.id.in_({linea.id_producto for linea in lineas}))}  # Cargo todos los productos del pedido en una sola consulta
+    factura = Factura(id_cliente=pedido.id_cliente, factura=json.dumps(
+        [[str(linea.id_producto), str(linea.cantidad)] for linea in lineas]))
     db.session.add(factura)
-    pedido.delete()
-    db.session.commit()
+    db.session.flush()  # Así ya tenemos el id de la factura para sus líneas
+    lineas_factura = [FacturaLinea(factura.id, productos_facturados[linea.id_producto], linea.cantidad) for linea in
+                      lineas]  # Guardo los precios de los productos tal y como están al facturar
+    db.session.add_all(lineas_factura)
+    # Modifico la contabiliad con el precio de cada línea, así la factura, sus movimientos y el resumen mensual suman
+    # lo mismo. Todos los movimientos se insertan de una vez
+    libro_mayor.registra_varios(db.session, [
+        {"id_producto": linea.id_producto, "id_cliente": pedido.id_cliente,
+         "id_proveedor": productos_facturados[linea.id_producto].id_proveedor, "cantidad": linea.cantidad,
+         "importe": linea.precio_final, "gasto": linea.precio_final} for linea in lineas_factura])
+    factura.total = round(sum(linea.precio_final for linea in lineas_factura), 2)
+    db.session.query(PedidoLinea).filter_by(id_pedido=pedido.id).delete(synchronize_session=False)
+    db.session.delete(pedido)
+    db.session.commit()  # La factura, la contabilidad y el pedido borrado se guardan juntos
     return redirect(url_for("facturas"))
 
 
@@ -557,24 +560,31 @@ def crear_factura():
 # ÚLTIMOS MOVIMIENTOS
 @app.route("/estadisticas")
 def estadisticas():
-    if session["admin"] == 1:  # Está conectado el administrador
-        entradas = db.session.query(Contabilidad).all()[-10:]  # Seleccionamos las 10 últimas entradas de contabilidad
-    elif session["admin"] == 2:  # Está conectado un usuario
-        entradas = db.session.query(Contabilidad).filter_by(id_cliente=session["id"]).all()[
-                   -10:]  # Filtramos por el usuario y seleccionamos sus últimas 10 entradas
+    consulta = db.session.query(Contabilidad)
+    if session["admin"] != 1:  # No es el administrador, así que filtramos por los movimientos del usuario
+        consulta = consulta.filter_by(id_cliente=session["id"])
+    # Solo leemos las 10 últimas entradas de contabilidad, en orden de más antigua a más reciente
+    entradas = consulta.order_by(desc(Contabilidad.id)).limit(10).all()[::-1]
+    # Cargo los productos, clientes y proveedores de esas entradas con una consulta de cada
+    productos = {producto.id: producto for producto in db.session.query(Productos).filter(
+        Productos.id.in_({entrada.id_producto for entrada in entradas}))}
+    clientes = {cliente.id: cliente for cliente in db.session.query(Usuario).filter(
+        Usuario.id.in_({entrada.id_cliente for entrada in entradas if entrada.id_cliente is not None}))}
+    proveedores = {proveedor.id: proveedor for proveedor in db.session.query(Proveedor).filter(
+        Proveedor.id.in_({entrada.id_proveedor for entrada in entradas}))}
     ultimas_entradas = []
 
     for ultimas in entradas:
         ult = []
-        producto = db.session.query(Productos).filter_by(id=ultimas.id_producto).first()
-        cliente = db.session.query(Usuario).filter_by(id=ultimas.id_cliente).first()
+        producto = productos.get(ultimas.id_producto)
+        cliente = clientes.get(ultimas.id_cliente)
         if cliente == None:  # Significa que está que el movimiento ha sido una compra a un proveedor
             cliente = None
             precio = int(ultimas.cantidad) * float(producto.precio_compra) * (-1)  # La muestro negativo
         else:  # El movimiento ha sido una venta a un cliente
             cliente = cliente.usuario
             precio = round(int(ultimas.cantidad) * float(producto.precio_venta) * 1.21, 2)
-        proveedor = db.session.query(Proveedor).filter_by(id=ultimas.id_proveedor).first()
+        proveedor = proveedores.get(ultimas.id_proveedor)
         proveedor = proveedor.empresa
         ult.append(producto.modelo)
         ult.append(cliente)
@@ -587,113 +597,173 @@ def estadisticas():
         ultimas_entradas.append(ult)
 
     # DIFERENCIA PRECIOS COMPRA-VENTA
-    if session["admin"] == 1:
-        mayor_beneficio = db.session.query(Productos).all()
-        df_beneficio = crea_df(mayor_beneficio)
-        df_beneficio['beneficio'] = df_beneficio['Precio Venta'] - df_beneficio['Precio Compra']
-        df_beneficio_mayor = df_beneficio.sort_values(by="beneficio").head(10)
-        df_beneficio_mayor = df_beneficio_mayor.drop('beneficio', axis=1)
-
-        df_beneficio_menor = df_beneficio.sort_values(by="beneficio", ascending=False).head(10)
-        df_beneficio_menor = df_beneficio_menor.drop('beneficio', axis=1)
-
-        df_beneficio_mayor.plot(x="Productos", kind="bar", stacked=True, rot=70)
-        archivo = "static/imagenes/graficos/grafico1.png"
-
-        plt.title("MAYOR BENEFICIO", color="red", fontweight="bold")
-        plt.xlabel("Productos", color="red")
-        plt.ylabel("EUROS (€)", color="red")
-
-        plt.savefig(archivo, bbox_inches='tight')  # bbox_inches='tight', hace que se guarde la imagen completa
-        plt.close()
-        df_beneficio_menor.plot(x="Productos", kind="bar", stacked=True, rot=70)
-        archivo = "static/imagenes/graficos/grafico2.png"
-        plt.title("MENOR BENEFICIO", color="red", fontweight="bold")
-        plt.xlabel("Productos", color="red")
-        plt.ylabel("EUROS (€)", color="red")
-
-        plt.savefig(archivo, bbox_inches='tight')  # bbox_inches='tight', hace que se guarde la imagen completa
-        plt.close()
+    admin = session["admin"] == 1
+    propietario = "admin" if admin else session["id"]  # Cada usuario tiene sus propias gráficas
+    version = graficos.version_datos()
+    graficas = {}  # Rutas de las gráficas que mostramos en la página
+    if admin:  # Encargamos las gráficas y las dejamos dibujándose mientras se carga la página
+        for tipo, nombre in (("mayor_beneficio", "grafico1"), ("menor_beneficio", "grafico2")):
+            encarga_grafico(tipo, "todos", admin, propietario, version)
+            graficas[nombre] = url_for("grafico", tipo=tipo, anyo="todos", v=version, u=propietario)
 
     # CONTABILIDAD
-    if session["admin"] == 1:  # Conectado el administrador
-        fechas = db.session.query(Contabilidad).all()  # Seleccionamos todos los campos de contabilidad
-    elif session["admin"] == 2:  # Conectado un usuario
-        fechas = db.session.query(Contabilidad).filter_by(
-            id_cliente=session["id"]).all()  # Seleccionamos solo los productos que ha comprado
-    anyos = []  # En esta lista añadiremos los años en los que ha habido compras y ventas
-
-    for i in fechas:  # Recorro todos los campos de contabilidad
-        if i.fecha.year not in anyos:  # Selecciono los años que no se repiten y los almaceno en una lista
-            anyos.append(i.fecha.year)
-
-    for i in anyos:  # Voy a crear una gráfica con la contabilidad de cada año por meses
-        meses = []
-        cantidad = []
-        precios_producto = []
-        for j in fechas:  # Recorro todos los campos de Contabilidad
-            if j.fecha.year == i:  # Los voy filtrando por año
-                mes = j.fecha.month
-                if session["admin"] == 1:
-                    meses.append(mes)  # Almaceno en una lista todos los meses en los que hay movimientos
-                    cantidad.append(j.beneficio)  # Almaceno en una lista el beneficio final de cada movimiento
-                elif session["admin"] == 2:
-                    producto = db.session.query(Productos).filter_by(id=j.id_producto).first()
-                    meses.append(mes)  # Almaceno en una lista todos los meses en los que hay movimientos
-                    cantidad.append(j.cantidad)  # Almaceno en una lista el beneficio final de cada movimiento
-                    precios_producto.append(producto.precio_final)
-
-        nombre_meses = []
-        cantidades = []
-        if session["admin"] == 1:
-            df1 = DataFrame({'mes': meses, 'beneficio': cantidad})  # Creo un dataframe con los meses y
-            serie1 = df1.groupby("mes")[
-                "beneficio"].last()  # Agrupo por meses y elijo el último movimiento de beneficio de cada mes
-        elif session["admin"] == 2:
-            df1 = DataFrame({'mes': meses, 'beneficio': cantidad, 'precio': precios_producto})
-            df1["precio_total"] = df1["beneficio"] * df1["precio"]
-            serie1 = df1.groupby("mes")["precio_total"].sum()  # Agrupo por meses y sumo los precios totales
-        cont = 1
-        for num_mes in range(1, 13):  # Asigno a cada mes la cantidad de ventas
-            nombre_meses.append(calendar.month_name[num_mes])
-            if num_mes in serie1.index:
-                cantidades.append(serie1[num_mes])
-            elif num_mes not in serie1.index and num_mes > serie1.index[0] and session["admin"] == 1:
-                cantidades.append(serie1[num_mes - cont])
-                cont += 1
-            else:
-                cantidades.append(0)
-
-        df2 = DataFrame({'mes': nombre_meses, 'beneficio': cantidades})  # Creo un Dataframe
-        plt.close("all")  # Cierro matplotlib por si estuviese abierto y evitar errores
-        if session["admin"] == 1:
-            sns.lineplot(x='mes', y='beneficio',
-                         data=df2)  # Creo una gráfica de líneas con los valores del dataframe df2
-        elif session["admin"] == 2:
-            sns.barplot(x='mes', y='beneficio', data=df2)
-        archivo = "static/imagenes/graficos/" + str(i) + ".png"  # Creo una ruta para almacenar la gráfica
-        plt.title("Contabilidad " + str(i), color="red", fontweight="bold")
-        plt.xlabel("Meses", color="red")
-        if session["admin"] == 1:
-            plt.ylabel("Beneficios", color="red")
-        elif session["admin"] == 2:
-            plt.ylabel("Gasto por mes", color="red")
-        plt.xticks(rotation=30)  # Roto los valores del eje x para que no se pisen
-        plt.savefig(archivo, bbox_inches='tight')  # Guardo la gráfica en la ruta
-        plt.close("all")  # Cierro el matplotlib
+    contabilidad = contabilidad_mensual(admin, session["id"])  # Un valor por cada año y mes con movimientos
+    anyos = list(contabilidad)  # Años en los que ha habido compras y ventas
+
+    for i in anyos:  # Cada año tiene su gráfica, se dibujan en paralelo y se sirven desde la ruta /grafico
+        encarga_grafico("contabilidad", str(i), admin, propietario, version, contabilidad[i])
+        graficas[i] = url_for("grafico", tipo="contabilidad", anyo=i, v=version, u=propietario)
     return render_template("estadisticas.html", ultimas_entradas=ultimas_entradas, nombre_imagenes=anyos,
-                           cierra_sesion="Cerrar Sesión")
+                           graficas=graficas, cierra_sesion="Cerrar Sesión")
+
+
+@app.route("/grafico/<tipo>/<anyo>")
+@login_required  # Solo pueden acceder los usuarios registrados
+def grafico(tipo, anyo):  # Sirve el PNG de una gráfica de estadísticas cuando termina de dibujarse
+    admin = session["admin"] == 1
+    if tipo not in ("mayor_beneficio", "menor_beneficio", "contabilidad") or (tipo != "contabilidad" and not admin):
+        abort(404)
+    if tipo == "contabilidad" and not anyo.isdigit():
+        abort(404)
+    propietario = "admin" if admin else session["id"]  # Cada usuario tiene sus propias gráficas
+    version = graficos.version_datos()
+    etag = graficos.etag(tipo, anyo, propietario, version)
+    if etag in request.if_none_match:  # El navegador ya tiene esta versión de la gráfica
+        return Response(status=304, headers={"ETag": '"' + etag + '"'})
+
+    # La gráfica se dibuja en otro proceso, pero esta petición ocupa un hilo del worker mientras espera, como mucho
+    # ESPERA_MAXIMA segundos
+    try:
+        png = encarga_grafico(tipo, anyo, admin, propietario, version).result(timeout=graficos.ESPERA_MAXIMA)
+    except TimeoutError:  # El navegador no reintenta las imágenes, así que se verá rota hasta recargar la página.
+        # La gráfica sigue dibujándose y al recargar se sirve desde la caché
+        return Response(status=503, headers={"Retry-After": "2"})
+    respuesta = Response(png, mimetype="image/png")
+    respuesta.set_etag(etag)
+    respuesta.cache_control.private = True  # Las gráficas son de cada usuario, no se guardan en cachés compartidas
+    # No se marcan como inmutables aunque la URL lleve la versión: si la versión no recogiera algún cambio de los
+    # datos, el navegador guardaría la gráfica antigua un año. Con no_cache la revalida con el ETag cada vez y, si no
+    # ha cambiado, recibe un 304 sin que se vuelva a dibujar
+    respuesta.cache_control.no_cache = True
+    return respuesta
+
+
+def encarga_grafico(tipo, anyo, admin, propietario, version, meses=None):  # Manda dibujar una gráfica al pool de procesos
+    if tipo == "contabilidad":
+        def datos():  # Solo se llama si la gráfica de este año no está en caché
+            anyo_grafico = int(anyo)
+            valores = meses
+            if valores is None:  # No nos han pasado los datos del año, así que los consultamos
+                valores = contabilidad_mensual(admin, session["id"], anyo_grafico).get(anyo_grafico)
+            if not valores:  # No hay movimientos en ese año, así que no hay gráfica
+                abort(404)
+            return valores, anyo_grafico, admin
+
+        return graficos.encarga(tipo, anyo, propietario, version, graficos.dibuja_contabilidad, datos)
+
+    def datos():
+        return graficos.datos_beneficio(), tipo == "mayor_beneficio"
+
+    return graficos.encarga(tipo, anyo, propietario, version, graficos.dibuja_beneficio, datos)
+
+
+def contabilidad_mensual(admin, id_cliente, anyo=None):  # Lee el resumen mensual de contabilidad
+    # Para el administrador es el beneficio del último movimiento de cada mes y para un cliente lo que ha gastado
+    # cada mes, como mucho 12 filas por año. Devuelve un diccionario {año: {mes: valor}}
+    if admin:
+        consulta = db.session.query(ContabilidadMensual.anyo, ContabilidadMensual.mes,
+                                    ContabilidadMensual.beneficio).filter_by(id_cliente=libro_mayor.TIENDA)
+    else:
+        consulta = db.session.query(ContabilidadMensual.anyo, ContabilidadMensual.mes,
+                                    ContabilidadMensual.gasto).filter_by(id_cliente=id_cliente)
+    if anyo is not None:
+        consulta = consulta.filter_by(anyo=anyo)
+    contabilidad = {}
+    for anyo_fila, mes, valor in consulta.order_by(ContabilidadMensual.anyo, ContabilidadMensual.mes):
+        contabilidad.setdefault(anyo_fila, {})[mes] = valor
+    return contabilidad
+
+
+# ----------------------EXPORTACIONES---------------------------------------
+
+@app.route("/exportar/<tipo>")
+@login_required  # Solo pueden acceder los usuarios registrados
+def exportar(tipo):  # Descarga en CSV las facturas, los pedidos o la contabilidad, filtrados por fechas y cliente
+    admin = session["admin"] == 1
+    if tipo not in exportacion.TIPOS or (tipo == "contabilidad" and not admin):
+        abort(404)
+    try:  # Fechas en formato AAAA-MM-DD
+        desde = date.fromisoformat(request.args["desde"]) if request.args.get("desde") else None
+        hasta = date.fromisoformat(request.args["hasta"]) if request.args.get("hasta") else None
+        id_cliente = int(request.args["cliente"]) if request.args.get("cliente") else None
+    except ValueError:
+        abort(400)
+    if not admin:  # Un cliente solo puede descargar lo suyo
+        id_cliente = session["id"]
+    cabecera, filas = exportacion.consulta(db.session, tipo, desde, hasta, id_cliente)
+    # stream_with_context mantiene la petición (y su sesión de la base de datos) mientras se envía el CSV
+    return Response(stream_with_context(exportacion.csv_por_lotes(cabecera, filas)), mimetype="text/csv",
+                    headers={"Content-Disposition": "attachment; filename={}.csv".format(tipo)})
+
+
+@app.cli.command("reconstruye-contabilidad")
+def reconstruye_contabilidad():  # flask --app main reconstruye-contabilidad: rellena el resumen mensual de contabilidad
+    migraciones.actualiza_esquema(db.engine)
+    # El gasto de los clientes sale de factura_linea, así que antes pasamos allí las facturas guardadas en JSON
+    migraciones.migra_facturas(db.session)
+    libro_mayor.reconstruye(db.session)
+    graficos.cambia_datos(db.session)  # Las gráficas de contabilidad se dibujan con el resumen mensual
+    db.session.commit()
+    print("Resumen mensual de contabilidad reconstruido")
+
+
+@app.cli.command("migra-facturas")
+def migra_facturas():  # flask --app main migra-facturas: pasa las facturas en JSON a la tabla factura_linea
+    migraciones.actualiza_esquema(db.engine)
+    migradas = migraciones.migra_facturas(db.session)
+    db.session.commit()
+    print("Facturas migradas: {}".format(migradas))
+
+
+@app.cli.command("migra-pedidos")
+def migra_pedidos():  # flask --app main migra-pedidos: pasa los pedidos en JSON a la tabla pedido_linea
+    migrados = migraciones.actualiza_esquema(db.engine)  # Entre otras cosas pasa los pedidos a pedido_linea
+    print("Pedidos migrados: {}".format(migrados))
+
+
+@app.cli.command("importa")
+@click.argument("tipo", type=click.Choice(list(importacion.COLUMNAS)))
+@click.argument("archivo", type=click.Path(exists=True, dir_okay=False))
+@click.option("--errores", type=click.Path(dir_okay=False), help="CSV donde se guardan las filas con errores")
+def importa(tipo, archivo, errores):  # flask --app main importa productos catalogo.csv --errores errores.csv
+    # Sin --errores las filas con errores se muestran por la salida de errores
+    salida = open(errores, "w", encoding="utf-8", newline="") if errores else contextlib.nullcontext(sys.stderr)
+    with open(archivo, encoding="utf-8-sig", newline="") as texto, salida as salida:
+        importadas, con_error = importacion.importa(db.session, tipo, texto, salida)
+    print("Filas importadas: {}, con errores: {}".format(importadas, con_error))
+
+
+@app.cli.command("crea-busqueda")
+def crea_busqueda():  # flask --app main crea-busqueda: crea el índice de búsqueda de productos y lo llena
+    migraciones.actualiza_esquema(db.engine)  # Entre otras cosas crea el índice de búsqueda si no existe
+    print("Índice de búsqueda listo")
+
+
+@app.cli.command("genera-miniaturas")
+def genera_miniaturas():  # flask --app main genera-miniaturas: crea las miniaturas de las categorías que no las tienen
+    migraciones.actualiza_esquema(db.engine)
+    rutas = {categoria.imagen for categoria in db.session.query(Categoria).filter(Categoria.variantes.is_(None))}
+    for futuro in [imagenes.encarga_miniaturas(ruta) for ruta in rutas]:
+        if futuro is not None:
+            futuro.result()
+    print("Imágenes procesadas: {}".format(len(rutas)))
 
 
-def crea_df(productos):  # Función que me crea Dataframes pasándole objetos de productos
-    precios_totales = []
-    for i in productos:
-        precios = []
-        precios.append(i.modelo)
-        precios.append(i.precio_final)
-        precios.append(i.precio_compra)
-        precios_totales.append(precios)
-    return pd.DataFrame(precios_totales, columns=['Productos', "Precio Compra", "Precio Venta"])
+@app.cli.command("migra-claves")
+def migra_claves():  # flask --app main migra-claves: quita eliminado de la clave primaria de las tablas
+    migradas = migraciones.migra_claves_primarias(db.engine)
+    migraciones.actualiza_esquema(db.engine)
+    print("Tablas migradas: {}".format(", ".join(migradas) or "ninguna"))
 
 
 def status_401(
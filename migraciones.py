@@ -0,0 +1,124 @@
+import contextlib
+import json
+from sqlalchemy import inspect, text
+import db
+import busqueda
+from models import Factura, FacturaLinea, Productos, Pedido, PedidoLinea, Usuario, Proveedor, Categoria
+
+
+def actualiza_esquema(engine):  # Crea las tablas que falten y añade a las existentes las columnas e índices nuevos
+    # También quita el NOT NULL de las columnas que ahora admiten valores vacíos y pasa a pedido_linea los pedidos
+    # guardados en JSON, que las rutas ya no leen. Devuelve cuántos pedidos ha pasado
+    db.Base.metadata.create_all(engine)
+    with _transaccion(engine) as conexion:
+        inspector = inspect(conexion)
+        for tabla in db.Base.metadata.sorted_tables:
+            existentes = {columna["name"]: columna for columna in inspector.get_columns(tabla.name)}
+            for columna in tabla.columns:
+                if columna.name not in existentes:  # Solo se pueden añadir columnas que admitan valores vacíos
+                    conexion.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                        tabla.name, columna.name, columna.type.compile(engine.dialect))))
+            opcionales = [columna.name for columna in tabla.columns if columna.nullable and not columna.primary_key
+                          and columna.name in existentes and not existentes[columna.name]["nullable"]]
+            if opcionales and conexion.dialect.name == "sqlite":  # SQLite no puede quitar un NOT NULL
+                _reconstruye(conexion, inspector, tabla)
+            for nombre in opcionales if conexion.dialect.name != "sqlite" else []:
+                conexion.execute(text("ALTER TABLE {} ALTER COLUMN {} DROP NOT NULL".format(tabla.name, nombre)))
+            indices = {indice["name"] for indice in inspector.get_indexes(tabla.name)}
+            for indice in tabla.indexes:
+                if indice.name not in indices:
+                    indice.create(conexion)
+        crea_busqueda(conexion)
+        sesion = db.Session(bind=conexion)  # Se guarda con el resto de cambios al salir del with
+        migrados = migra_pedidos(sesion)
+        sesion.flush()
+        sesion.close()
+    return migrados
+
+
+def crea_busqueda(conexion):  # Crea el índice de texto completo de los productos y sus triggers si no existen
+    if conexion.dialect.name != "sqlite":  # Las demás bases de datos buscan sin índice (ver busqueda.busca)
+        return False
+    existentes = set(conexion.execute(text("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')")).scalars())
+    if existentes.issuperset((busqueda.TABLA,) + busqueda.TRIGGERS):
+        return False
+    for sentencia in busqueda.DDL:
+        conexion.execute(text(sentencia))
+    # Sin todos los triggers el índice puede haberse quedado atrasado, así que lo volvemos a llenar desde producto
+    conexion.execute(text("INSERT INTO producto_fts(producto_fts) VALUES ('rebuild')"))
+    return True
+
+
+@contextlib.contextmanager
+def _transaccion(engine):  # Conexión con una transacción que en SQLite también deshace ALTER TABLE y CREATE TABLE
+    with engine.connect() as conexion:
+        sqlite = conexion.dialect.name == "sqlite"
+        if sqlite:  # pysqlite solo abre la transacción antes de INSERT, UPDATE y DELETE, así que ALTER TABLE y
+            # CREATE TABLE se confirmarían por su cuenta. Sin isolation_level la abrimos nosotros con BEGIN
+            crudo = conexion.connection.driver_connection
+            nivel, crudo.isolation_level = crudo.isolation_level, None
+        try:
+            with conexion.begin():
+                if sqlite:
+                    conexion.exec_driver_sql("BEGIN")
+                yield conexion
+        finally:
+            if sqlite:
+                crudo.isolation_level = nivel
+
+
+def migra_claves_primarias(engine):  # Deja solo el id en la clave primaria de las tablas con eliminado
+    # Antes eliminado (y cantidad_max en producto) formaban parte de la clave primaria. Todo se hace en una sola
+    # transacción: si falla una tabla no se cambia ninguna
+    migradas = []
+    with _transaccion(engine) as conexion:
+        inspector = inspect(conexion)
+        for tabla in (Usuario.__table__, Proveedor.__table__, Productos.__table__, Categoria.__table__):
+            if not inspector.has_table(tabla.name + "_antigua") and (  # Una migración anterior se quedó a medias
+                    not inspector.has_table(tabla.name) or
+                    inspector.get_pk_constraint(tabla.name)["constrained_columns"] == ["id"]):
+                continue  # Las tablas que no existen las crea actualiza_esquema
+            _reconstruye(conexion, inspector, tabla)
+            migradas.append(tabla.name)
+    return migradas
+
+
+def _reconstruye(conexion, inspector, tabla):  # Vuelve a crear la tabla con el esquema del modelo y copia sus filas
+    # No se puede cambiar la clave primaria ni quitar un NOT NULL de una tabla de SQLite, así que la renombramos,
+    # creamos la nueva y copiamos las filas. Si ya existe la tabla _antigua, seguimos desde ella
+    if not inspector.has_table(tabla.name + "_antigua"):
+        for indice in inspector.get_indexes(tabla.name):  # Los índices no pueden repetir nombre
+            conexion.execute(text("DROP INDEX {}".format(indice["name"])))
+        conexion.execute(text("ALTER TABLE {0} RENAME TO {0}_antigua".format(tabla.name)))
+    tabla.create(conexion, checkfirst=True)
+    # Solo copiamos las columnas que ya existían, las nuevas (como variantes en categoria) se quedan vacías
+    existentes = {columna["name"] for columna in inspector.get_columns(tabla.name + "_antigua")}
+    columnas = ", ".join(columna.name for columna in tabla.columns if columna.name in existentes)
+    conexion.execute(text("DELETE FROM {}".format(tabla.name)))
+    conexion.execute(text("INSERT INTO {0} ({1}) SELECT {1} FROM {0}_antigua".format(tabla.name, columnas)))
+    conexion.execute(text("DROP TABLE {}_antigua".format(tabla.name)))
+
+
+def migra_facturas(sesion):  # Pasa las facturas guardadas en JSON a la tabla factura_linea y calcula su total
+    facturas = sesion.query(Factura).filter(Factura.total.is_(None)).all()
+    ids_productos = {int(producto[0]) for factura in facturas for producto in json.loads(factura.factura)}
+    productos = {producto.id: producto for producto in
+                 sesion.query(Productos).filter(Productos.id.in_(ids_productos))}
+    for factura in facturas:  # Las facturas antiguas no guardaban precios, así que usamos los actuales
+        lineas = [FacturaLinea(factura.id, productos[int(producto[0])], int(producto[1])) for producto in
+                  json.loads(factura.factura)]
+        sesion.add_all(lineas)
+        factura.total = round(sum(linea.precio_final for linea in lineas), 2)
+    return len(facturas)
+
+
+def migra_pedidos(sesion, pedidos=None):  # Pasa los productos de los pedidos guardados en JSON a la tabla pedido_linea
+    # Sin pedidos migra todos los que falten
+    if pedidos is None:
+        pedidos = sesion.query(Pedido).filter(Pedido.pedido != "[]").all()
+    pedidos = [pedido for pedido in pedidos if pedido.pedido != "[]"]
+    for pedido in pedidos:
+        sesion.add_all([PedidoLinea(pedido.id, int(producto[0]), int(producto[1])) for producto in
+                        json.loads(pedido.pedido)])
+        pedido.pedido = "[]"  # Así sabemos que ya está migrado
+    return len(pedidos)
@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, Float, String, Date
+from sqlalchemy import Column, Integer, Float, String, Date, Index, text
+import json
 from datetime import datetime
 import db
 from flask_login import UserMixin
@@ -6,10 +7,27 @@ from werkzeug.security import check_password_hash  # Librería de encriptación
 from wtforms import Form, StringField, PasswordField, validators
 
 
-class Usuario(db.Base, UserMixin):
+ESCASEZ = 0.9  # Un producto está escaso cuando su stock baja de este porcentaje de la cantidad máxima
+
+
+def indice_activos(nombre, *columnas, unique=False, condicion=None):  # Índice parcial que solo incluye las filas sin eliminar
+    # condicion restringe todavía más las filas del índice, las consultas que la repiten solo leen esas filas
+    donde = "eliminado = 0" if condicion is None else "eliminado = 0 AND " + condicion
+    return Index(nombre, *columnas, unique=unique, sqlite_where=text(donde), postgresql_where=text(donde))
+
+
+class Eliminable:  # Modelos que no se borran, sino que se marcan con eliminado = 1
+    @classmethod
+    def activos(cls, sesion):  # Consulta las filas sin eliminar, el filtro lo hace la base de datos
+        return sesion.query(cls).filter(cls.eliminado == 0)
+
+
+class Usuario(db.Base, UserMixin, Eliminable):
     __tablename__ = "usuario"
-    __table_args__ = {
-        'sqlite_autoincrement': True}  # (Opcional) Para forzar que en mi tabla haya un identificador que vaya incrementando
+    __table_args__ = (
+        # Índice único de los emails de los usuarios sin eliminar, para buscar rápido al iniciar sesión
+        indice_activos("ux_usuario_email_activo", "email", unique=True),
+        {'sqlite_autoincrement': True})  # (Opcional) Para forzar que en mi tabla haya un identificador que vaya incrementando
     id = Column(Integer, primary_key=True)
     usuario = Column(String(20), nullable=False)
     telefono = Column(String(20), nullable=False)
@@ -22,7 +40,7 @@ class Usuario(db.Base, UserMixin):
     provincia = Column(String(50), nullable=False)
     admin = Column(Integer, nullable=False)
     antiguedad = Column(Date, nullable=False)
-    eliminado = Column(Integer, primary_key=True)
+    eliminado = Column(Integer, nullable=False)
 
     def __init__(self, usuario=None, telefono=None, email=None, contrasenia=None, nombre=None, apellido=None,
                  direccion=None, poblacion=None, provincia=None, admin=2, eliminado=0):
@@ -48,10 +66,11 @@ class Usuario(db.Base, UserMixin):
         return check_password_hash(hashed_contrasenia, contrasenia)
 
 
-class Proveedor(db.Base):
+class Proveedor(db.Base, Eliminable):
     __tablename__ = "proveedor"
-    __table_args__ = {
-        'sqlite_autoincrement': True}  # (Opcional) Para forzar que en mi tabla haya un identificador que vaya incrementando
+    __table_args__ = (
+        indice_activos("ix_proveedor_empresa_activo", "empresa"),
+        {'sqlite_autoincrement': True})  # (Opcional) Para forzar que en mi tabla haya un identificador que vaya incrementando
     id = Column(Integer, primary_key=True)
     empresa = Column(String(20), nullable=False)
     cif = Column(String(20), nullable=False)
@@ -61,7 +80,7 @@ class Proveedor(db.Base):
     poblacion = Column(String(50), nullable=False)
     provincia = Column(String(50), nullable=False)
     antiguedad = Column(Date, nullable=False)
-    eliminado = Column(Integer, primary_key=True)
+    eliminado = Column(Integer, nullable=False)
 
     def __init__(self, empresa, cif, telefono, email, direccion, poblacion, provincia, eliminado=0):
         self.empresa = empresa
@@ -79,9 +98,14 @@ class Proveedor(db.Base):
                                                                                              self.telefono, self.email)
 
 
-class Productos(db.Base):
+class Productos(db.Base, Eliminable):
     __tablename__ = "producto"
-    __table_args__ = {'sqlite_autoincrement': True}
+    __table_args__ = (indice_activos("ix_producto_categoria_activo", "categoria", "id"),
+                      indice_activos("ix_producto_id_proveedor_activo", "id_proveedor"),
+                      # Solo contiene los productos escasos, así la página de inicio no recorre todo el catálogo. La
+                      # base de datos lo mantiene al día cada vez que cambia el stock o la cantidad máxima
+                      indice_activos("ix_producto_escaso", "id", condicion="stock < cantidad_max * {}".format(ESCASEZ)),
+                      {'sqlite_autoincrement': True})
     id = Column(Integer, primary_key=True)
     categoria = Column(String(30), nullable=False)
     marca = Column(String(20), nullable=False)
@@ -91,10 +115,10 @@ class Productos(db.Base):
     precio_compra = Column(Float, nullable=False)
     precio_venta = Column(Float, nullable=False)
     iva = Column(Integer, nullable=False)
-    cantidad_max = Column(Integer, primary_key=True)
+    cantidad_max = Column(Integer, nullable=False)
     stock = Column(Integer, nullable=False)
     precio_final = Column(Float, nullable=False)
-    eliminado = Column(Integer, primary_key=True)
+    eliminado = Column(Integer, nullable=False)
 
     def __init__(self, categoria=None, marca=None, modelo=None, descripcion=None, id_proveedor=None, precio_compra=0,
                  precio_venta=0, cantidad_max=0, stock=0, iva=21, eliminado=0):
@@ -115,34 +139,51 @@ class Productos(db.Base):
         return "El producto marca {} y modelo {}, tiene un precio final de {} y hay en stock {} unidades".format(
             self.marca, self.modelo, self.precio_final, self.stock)
 
+    @classmethod
+    def escasos(cls, sesion):  # Consulta los productos con poco stock, que se leen del índice ix_producto_escaso
+        return cls.activos(sesion).filter(cls.stock < cls.cantidad_max * ESCASEZ)
+
 
-class Categoria(db.Base):
+class Categoria(db.Base, Eliminable):
     __tablename__ = "categoria"
-    __table_args__ = {
-        'sqlite_autoincrement': True}  # (Opcional) Para forzar que en mi tabla haya un identificador que vaya incrementando
+    __table_args__ = (
+        indice_activos("ix_categoria_nombre_activo", "nombre"),
+        {'sqlite_autoincrement': True})  # (Opcional) Para forzar que en mi tabla haya un identificador que vaya incrementando
     id = Column(Integer, primary_key=True)
     nombre = Column(String(30), nullable=False)
     imagen = Column(String(200), nullable=False)
-    eliminado = Column(Integer, primary_key=True)
+    eliminado = Column(Integer, nullable=False)
+    # Miniaturas de la imagen en JSON, {ancho: {formato: ruta}}. Vacío mientras se generan en segundo plano
+    variantes = Column(String(1000))
 
-    def __init__(self, nombre, imagen, eliminado=0):
+    def __init__(self, nombre, imagen, eliminado=0, variantes=None):
         self.nombre = nombre
         self.imagen = imagen
         self.eliminado = eliminado
+        self.variantes = variantes
 
     def __str__(self):
         return "la categoría {} tiene una imagen en la ruta {}".format(self.nombre, self.imagen)
 
+    def miniatura(self, ancho=200, formato="webp"):  # Ruta de la miniatura más pequeña que tenga al menos ese ancho
+        # Si todavía no hay miniaturas devuelve la imagen original
+        variantes = json.loads(self.variantes) if self.variantes else {}
+        for tamanyo in sorted(variantes, key=int):
+            if int(tamanyo) >= ancho and formato in variantes[tamanyo]:
+                return variantes[tamanyo][formato]
+        return self.imagen
+
 
 class Pedido(db.Base):
     __tablename__ = "pedido"
-    __table_args__ = {'sqlite_autoincrement': True}
+    __table_args__ = (Index("ix_pedido_id_cliente", "id_cliente", "id"),  # Pedidos de un cliente en orden, para paginar
+                      {'sqlite_autoincrement': True})
     id = Column(Integer, primary_key=True)
     id_cliente = Column(Integer, nullable=False)
-    pedido = Column(String(2000), nullable=False)
+    pedido = Column(String(2000), nullable=False)  # Columna antigua con los productos en JSON, ahora van en pedido_linea
     fecha = Column(Date, nullable=False)
 
-    def __init__(self, id_cliente, pedido):
+    def __init__(self, id_cliente, pedido="[]"):
         self.id_cliente = id_cliente
         self.pedido = pedido
         self.fecha = datetime.today()
@@ -152,30 +193,82 @@ class Pedido(db.Base):
                                                                                          self.fecha)
 
 
+class PedidoLinea(db.Base):  # Cada producto de un pedido con su cantidad
+    __tablename__ = "pedido_linea"
+    __table_args__ = (Index("ix_pedido_linea_id_pedido", "id_pedido"),
+                      Index("ix_pedido_linea_id_producto", "id_producto"), {'sqlite_autoincrement': True})
+    id = Column(Integer, primary_key=True)
+    id_pedido = Column(Integer, nullable=False)
+    id_producto = Column(Integer, nullable=False)
+    cantidad = Column(Integer, nullable=False)
+
+    def __init__(self, id_pedido, id_producto, cantidad):
+        self.id_pedido = id_pedido
+        self.id_producto = id_producto
+        self.cantidad = cantidad
+
+    def __str__(self):
+        return "El pedido {} incluye {} unidades del producto {}".format(self.id_pedido, self.cantidad,
+                                                                         self.id_producto)
+
+
 class Factura(db.Base):
     __tablename__ = "factura"
-    __table_args__ = {'sqlite_autoincrement': True}
+    __table_args__ = (Index("ix_factura_id_cliente", "id_cliente", "id"),  # Facturas de un cliente en orden, para paginar
+                      {'sqlite_autoincrement': True})
     id = Column(Integer, primary_key=True)
     id_cliente = Column(Integer, nullable=False)
     factura = Column(String(2000), nullable=False)
     fecha = Column(Date, nullable=False)
+    total = Column(Float)  # Precio total de la factura al crearla (vacío en las facturas anteriores a migrarlas)
 
-    def __init__(self, id_cliente, factura):
+    def __init__(self, id_cliente, factura, total=None):
         self.id_cliente = id_cliente
         self.factura = factura
         self.fecha = datetime.today()
+        self.total = total
 
     def __str__(self):
         return "La factura {} pertenece al cliente {} y se realizó en la fecha {}".format(self.id, self.id_cliente,
                                                                                           self.fecha)
 
 
+class FacturaLinea(db.Base):  # Cada producto de una factura, con los precios que tenía al facturarlo
+    __tablename__ = "factura_linea"
+    __table_args__ = (Index("ix_factura_linea_id_factura", "id_factura"), {'sqlite_autoincrement': True})
+    id = Column(Integer, primary_key=True)
+    id_factura = Column(Integer, nullable=False)
+    id_producto = Column(Integer, nullable=False)
+    categoria = Column(String(30), nullable=False)
+    marca = Column(String(20), nullable=False)
+    modelo = Column(String(20), nullable=False)
+    cantidad = Column(Integer, nullable=False)
+    precio_venta = Column(Float, nullable=False)
+    iva = Column(Integer, nullable=False)
+    precio_final = Column(Float, nullable=False)  # Precio de la línea con IVA (precio de venta con IVA * cantidad)
+
+    def __init__(self, id_factura, producto, cantidad):  # Copia los datos del producto tal y como están ahora
+        self.id_factura = id_factura
+        self.id_producto = producto.id
+        self.categoria = producto.categoria
+        self.marca = producto.marca
+        self.modelo = producto.modelo
+        self.cantidad = cantidad
+        self.precio_venta = producto.precio_venta
+        self.iva = producto.iva
+        self.precio_final = round((producto.iva / 100 * producto.precio_venta + producto.precio_venta) * cantidad, 2)
+
+    def __str__(self):
+        return "La factura {} incluye {} unidades del producto {} por {}€".format(self.id_factura, self.cantidad,
+                                                                                 self.modelo, self.precio_final)
+
+
 class Contabilidad(db.Base):
     __tablename__ = "contabilidad"
     __table_args__ = {'sqlite_autoincrement': True}
     id = Column(Integer, primary_key=True)
     id_producto = Column(Integer, nullable=False)
-    id_cliente = Column(Integer, nullable=False)
+    id_cliente = Column(Integer)  # Vacío en las compras a proveedores
     id_proveedor = Column(Integer, nullable=False)
     cantidad = Column(Integer, nullable=False)
     fecha = Column(Date, nullable=False)
@@ -195,6 +288,53 @@ class Contabilidad(db.Base):
                                                                                                       self.id_cliente)
 
 
+class Saldo(db.Base):  # Beneficio acumulado de la tienda, una sola fila que se actualiza con cada movimiento
+    __tablename__ = "saldo"
+    id = Column(Integer, primary_key=True)
+    beneficio = Column(Float, nullable=False)
+
+    def __init__(self, beneficio=0, id=1):
+        self.id = id
+        self.beneficio = beneficio
+
+    def __str__(self):
+        return "El beneficio acumulado es de {}€".format(self.beneficio)
+
+
+class VersionDatos(db.Base):  # Contador de los cambios de las gráficas que no escriben en contabilidad, una sola fila
+    __tablename__ = "version_datos"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    def __init__(self, version=0, id=1):
+        self.id = id
+        self.version = version
+
+    def __str__(self):
+        return "Los datos de las gráficas van por la versión {}".format(self.version)
+
+
+class ContabilidadMensual(db.Base):  # Resumen de la contabilidad por meses, se actualiza con cada movimiento
+    __tablename__ = "contabilidad_mensual"
+    anyo = Column(Integer, primary_key=True)
+    mes = Column(Integer, primary_key=True)
+    id_cliente = Column(Integer, primary_key=True)  # 0 para el resumen de toda la tienda
+    beneficio = Column(Float, nullable=False)  # Beneficio tras el último movimiento del mes (resumen de la tienda)
+    gasto = Column(Float, nullable=False)  # Lo que ha gastado el cliente en el mes
+
+    def __init__(self, anyo, mes, id_cliente=0, beneficio=0, gasto=0):
+        self.anyo = anyo
+        self.mes = mes
+        self.id_cliente = id_cliente
+        self.beneficio = beneficio
+        self.gasto = gasto
+
+    def __str__(self):
+        return "En {}/{} el cliente {} ha gastado {}€ y el beneficio es de {}€".format(self.mes, self.anyo,
+                                                                                  self.id_cliente, self.gasto,
+                                                                                  self.beneficio)
+
+
 class RegistrationForm(Form):  # Clase para verificar los campos de los usuarios
     usuario = StringField('usuario', [validators.Length(min=4, max=25)])
     telefono = StringField('telefono', [validators.Length(min=4, max=25)])
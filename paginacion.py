@@ -0,0 +1,53 @@
+import base64
+import binascii
+import json
+import os
+from flask import request, abort
+from sqlalchemy import desc, tuple_
+from sqlalchemy.engine import Row
+
+TAMANYO = int(os.environ.get("TAMANYO_PAGINA", "50"))  # Filas por página si no se pide otro tamaño
+MAX_TAMANYO = 500  # Tamaño máximo de página que se puede pedir con ?por_pagina=
+
+
+def tamanyo():  # Tamaño de página pedido en la url, dentro de los límites
+    try:
+        por_pagina = int(request.args.get("por_pagina", TAMANYO))
+    except ValueError:
+        abort(400)
+    return min(max(por_pagina, 1), MAX_TAMANYO)
+
+
+def pagina(consulta, columnas, descendente=False):  # Devuelve las filas de una página y el cursor de la siguiente
+    # columnas son las columnas por las que se ordena, la última tiene que ser única (el id). En vez de saltar filas
+    # con OFFSET, que obliga a la base de datos a recorrer todas las páginas anteriores, cada página empieza justo
+    # después de la última fila de la anterior (el cursor de ?despues=), así que todas las páginas cuestan lo mismo
+    por_pagina = tamanyo()
+    despues = request.args.get("despues")
+    if despues:
+        clave, valores = tuple_(*columnas), tuple_(*_lee_cursor(despues, len(columnas)))
+        consulta = consulta.filter(clave < valores if descendente else clave > valores)
+    orden = [desc(columna) for columna in columnas] if descendente else columnas
+    filas = consulta.order_by(*orden).limit(por_pagina + 1).all()  # Una fila de más para saber si hay otra página
+    if len(filas) <= por_pagina:
+        return filas, None
+    filas = filas[:por_pagina]
+    ultima = filas[-1]
+    if isinstance(ultima, Row):  # Las columnas que no vienen en la fila se leen del modelo, que es el primer elemento
+        return filas, _cursor([ultima._mapping[columna] if columna in ultima._mapping else
+                               getattr(ultima[0], columna.key) for columna in columnas])
+    return filas, _cursor([getattr(ultima, columna.key) for columna in columnas])
+
+
+def _cursor(valores):  # Codifica los valores de la última fila para ponerlos en la url
+    return base64.urlsafe_b64encode(json.dumps(valores).encode()).decode().rstrip("=")
+
+
+def _lee_cursor(cursor, columnas):
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        abort(400)
+    if not isinstance(valores, list) or len(valores) != columnas:
+        abort(400)
+    return valores
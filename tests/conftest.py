@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import jinja2
+import pytest
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+# Las pruebas usan su propia base de datos SQLite, BASE_DATOS_URL se lee al importar db
+CARPETA = tempfile.mkdtemp(prefix="pruebas_")
+RUTA_DB = os.path.join(CARPETA, "pruebas.db")
+os.environ["BASE_DATOS_URL"] = "sqlite:///" + RUTA_DB
+CONTRASENIA = "contrasenia"
+
+import db  # noqa: E402
+import main  # noqa: E402
+import migraciones  # noqa: E402
+from models import Usuario  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():  # La aplicación sin las plantillas, que no están en el repositorio: las pruebas comprueban las vistas
+    main.app.config["TESTING"] = True
+    main.app.jinja_loader = jinja2.FunctionLoader(lambda nombre: "")
+    yield main.app
+    db.engine.dispose()
+    shutil.rmtree(CARPETA, ignore_errors=True)
+
+
+@pytest.fixture
+def base_datos(app):  # Cada prueba empieza con una base de datos vacía y el esquema al día
+    db.session.remove()
+    db.engine.dispose()
+    for sufijo in ("", "-wal", "-shm"):
+        if os.path.exists(RUTA_DB + sufijo):
+            os.remove(RUTA_DB + sufijo)
+    migraciones.actualiza_esquema(db.engine)
+    yield db.session
+    db.session.remove()
+
+
+@pytest.fixture
+def usuarios(base_datos):  # El administrador (id 1) y un cliente (id 2)
+    base_datos.add_all([
+        Usuario("admin", "600000000", "admin@tienda.es", generate_password_hash(CONTRASENIA), "Admin", "Tienda",
+                "Calle 1", "Madrid", "Madrid", admin=1),
+        Usuario("cliente", "600000001", "cliente@tienda.es", generate_password_hash(CONTRASENIA), "Cliente",
+                "Tienda", "Calle 2", "Madrid", "Madrid")])
+    base_datos.commit()
+    return {"admin": "admin@tienda.es", "cliente": "cliente@tienda.es"}
+
+
+@pytest.fixture
+def entra(app):  # Función que devuelve un navegador de pruebas con la sesión de un usuario iniciada
+    def entra(email):
+        navegador = app.test_client()
+        respuesta = navegador.post("/comprueba_usuario", data={"email": email, "contrasenia": CONTRASENIA})
+        assert respuesta.status_code == 302
+        return navegador
+
+    return entra
+
+
+@pytest.fixture
+def consultas():  # Lista con las sentencias que se ejecutan en la base de datos durante la prueba
+    sentencias = []
+
+    def anota(conexion, cursor, sentencia, *argumentos):
+        sentencias.append(sentencia)
+
+    event.listen(db.engine, "before_cursor_execute", anota)
+    yield sentencias
+    event.remove(db.engine, "before_cursor_execute", anota)
@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PESADAS = ("pandas", "matplotlib", "seaborn", "PIL")  # Solo se cargan al dibujar gráficas o generar miniaturas
+# Segundos que puede tardar import main. Aquí tarda unos 0,6 s, con las librerías de dibujo tardaba más de 1,6 s
+TIEMPO_MAXIMO = 1.2
+MIDE = """
+import json, sys, time
+inicio = time.perf_counter()
+import main
+print(json.dumps({"segundos": time.perf_counter() - inicio, "modulos": sorted(sys.modules)}))
+"""
+
+
+def test_import_main_no_carga_librerias_de_dibujo(tmp_path):
+    # En un intérprete nuevo, así no cuentan los módulos que ya hayan cargado otras pruebas
+    entorno = dict(os.environ, BASE_DATOS_URL="sqlite:///{}".format(tmp_path / "arranque.db"))
+    resultado = subprocess.run([sys.executable, "-c", MIDE], cwd=RAIZ, env=entorno, capture_output=True, text=True)
+    assert resultado.returncode == 0, resultado.stderr
+    medida = json.loads(resultado.stdout.splitlines()[-1])
+    cargadas = [modulo for modulo in medida["modulos"] if modulo.split(".")[0] in PESADAS]
+    assert cargadas == []
+    assert medida["segundos"] < TIEMPO_MAXIMO
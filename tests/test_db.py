@@ -0,0 +1,14 @@
+import os
+import subprocess
+import sys
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize("url", ["sqlite://", "sqlite:///:memory:"])
+def test_db_con_sqlite_en_memoria(url):  # SQLite en memoria no usa QueuePool, así que no admite su tamaño
+    entorno = dict(os.environ, BASE_DATOS_URL=url, POOL_TAMANYO="2", POOL_DESBORDE="1")
+    resultado = subprocess.run([sys.executable, "-c", "import db; db.engine.connect().close()"], cwd=RAIZ,
+                               env=entorno, capture_output=True, text=True)
+    assert resultado.returncode == 0, resultado.stderr
@@ -0,0 +1,33 @@
+import pytest
+import libro_mayor
+from models import ContabilidadMensual, Factura, FacturaLinea, Pedido, Productos, Proveedor
+
+
+@pytest.fixture
+def producto(base_datos, usuarios):  # Un producto con un precio que no da un número redondo con IVA
+    base_datos.add(Proveedor("Logitech", "B00000000", "910000000", "ventas@logitech.es", "Calle 3", "Madrid",
+                             "Madrid"))
+    base_datos.commit()
+    producto = Productos("Ratones", "Logitech", "M1", "Ratón", 1, 5, 9.99, 100, 100, iva=21)
+    base_datos.add(producto)
+    base_datos.commit()
+    return producto.id
+
+
+def gasto_cliente(sesion):
+    return sesion.query(ContabilidadMensual.gasto).filter_by(id_cliente=2).scalar()
+
+
+def test_factura_contabilidad_y_resumen_suman_lo_mismo(base_datos, producto, entra):
+    cliente = entra("cliente@tienda.es")
+    assert cliente.post("/crear_pedido", data={"id": [str(producto)], "cantidad": ["3"]}).status_code == 302
+    id_pedido = base_datos.query(Pedido.id).scalar()
+    base_datos.remove()
+    assert entra("admin@tienda.es").post("/crear-factura", data={"pedido": id_pedido}).status_code == 302
+
+    factura = base_datos.query(Factura).one()
+    assert factura.total == 36.26  # 3 * 9.99 * 1,21 = 36,2637
+    assert base_datos.query(FacturaLinea.precio_final).scalar() == factura.total
+    assert gasto_cliente(base_datos) == factura.total
+    libro_mayor.reconstruye(base_datos)  # Al reconstruir el resumen sale el mismo gasto
+    assert gasto_cliente(base_datos) == factura.total
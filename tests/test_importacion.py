@@ -0,0 +1,33 @@
+import csv
+import io
+from models import Categoria, Contabilidad, Productos, Proveedor, Saldo
+
+# La tercera fila tiene un proveedor que no existe y no se importa
+CSV_PRODUCTOS = (
+    "categoria;marca;modelo;descripcion;proveedor;precio_compra;precio_venta;iva;cantidad_max;stock\n"
+    "Ratones;Logitech;M1;Ratón;Logitech;5,5;10;21;100;4\n"
+    "Ratones;Logitech;M2;Ratón;Logitech;8;15;21;100;10\n"
+    "Ratones;Razer;R1;Ratón;Razer;20;40;21;100;3\n"
+)
+
+
+def test_importa_productos_y_su_compra(base_datos, usuarios, entra):
+    base_datos.add(Proveedor("Logitech", "B00000000", "910000000", "ventas@logitech.es", "Calle 3", "Madrid",
+                             "Madrid"))
+    base_datos.add(Categoria("Ratones", "../static/imagenes/ratones.png"))
+    base_datos.commit()
+    respuesta = entra("admin@tienda.es").post("/importar/productos", data={
+        "archivo": (io.BytesIO(CSV_PRODUCTOS.encode()), "productos.csv")})
+    assert respuesta.status_code == 200  # Devuelve el CSV de errores
+    errores = list(csv.reader(io.StringIO(respuesta.get_data(as_text=True))))
+    assert errores[0][:2] == ["linea", "error"]
+    assert errores[1][:2] == ["4", "No existe el proveedor Razer"]
+    assert len(errores) == 2
+    base_datos.remove()
+    productos = base_datos.query(Productos.id, Productos.modelo, Productos.stock).order_by(Productos.id).all()
+    assert [(modelo, stock) for _, modelo, stock in productos] == [("M1", 4), ("M2", 10)]
+    movimientos = base_datos.query(Contabilidad).order_by(Contabilidad.id).all()
+    assert [(m.id_producto, m.id_cliente, m.id_proveedor, m.cantidad) for m in movimientos] == [
+        (productos[0].id, None, 1, 4), (productos[1].id, None, 1, 10)]
+    assert movimientos[-1].beneficio == -(5.5 * 4 + 8 * 10)
+    assert base_datos.get(Saldo, 1).beneficio == -(5.5 * 4 + 8 * 10)
@@ -0,0 +1,90 @@
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import IntegrityError
+import migraciones
+
+# Tablas con eliminado (y cantidad_max en producto) en la clave primaria, como estaban antes de migra_claves_primarias
+ESQUEMA_ANTIGUO = (
+    "CREATE TABLE usuario (id INTEGER NOT NULL, usuario VARCHAR(20) NOT NULL, telefono VARCHAR(20) NOT NULL, "
+    "email VARCHAR(100) NOT NULL, contrasenia VARCHAR(200) NOT NULL, nombre VARCHAR(30) NOT NULL, "
+    "apellido VARCHAR(50) NOT NULL, direccion VARCHAR(100) NOT NULL, poblacion VARCHAR(50) NOT NULL, "
+    "provincia VARCHAR(50) NOT NULL, admin INTEGER NOT NULL, antiguedad DATE NOT NULL, eliminado INTEGER NOT NULL, "
+    "PRIMARY KEY (id, eliminado))",
+    "CREATE TABLE proveedor (id INTEGER NOT NULL, empresa VARCHAR(20) NOT NULL, cif VARCHAR(20) NOT NULL, "
+    "telefono VARCHAR(20) NOT NULL, email VARCHAR(100) NOT NULL, direccion VARCHAR(100) NOT NULL, "
+    "poblacion VARCHAR(50) NOT NULL, provincia VARCHAR(50) NOT NULL, antiguedad DATE NOT NULL, "
+    "eliminado INTEGER NOT NULL, PRIMARY KEY (id, eliminado))",
+    "CREATE TABLE producto (id INTEGER NOT NULL, categoria VARCHAR(30) NOT NULL, marca VARCHAR(20) NOT NULL, "
+    "modelo VARCHAR(20) NOT NULL, descripcion VARCHAR(200) NOT NULL, id_proveedor INTEGER NOT NULL, "
+    "precio_compra FLOAT NOT NULL, precio_venta FLOAT NOT NULL, iva INTEGER NOT NULL, cantidad_max INTEGER NOT NULL, "
+    "stock INTEGER NOT NULL, precio_final FLOAT NOT NULL, eliminado INTEGER NOT NULL, "
+    "PRIMARY KEY (id, cantidad_max, eliminado))",
+    "CREATE TABLE categoria (id INTEGER NOT NULL, nombre VARCHAR(30) NOT NULL, imagen VARCHAR(200) NOT NULL, "
+    "eliminado INTEGER NOT NULL, PRIMARY KEY (id, eliminado))",
+    "INSERT INTO usuario VALUES (1, 'admin', '600000000', 'admin@tienda.es', 'x', 'Admin', 'Tienda', 'Calle 1', "
+    "'Madrid', 'Madrid', 1, '2024-01-01', 0)",
+    "INSERT INTO proveedor VALUES (1, 'Logitech', 'B00000000', '910000000', 'ventas@logitech.es', 'Calle 3', "
+    "'Madrid', 'Madrid', '2024-01-01', 0)",
+    "INSERT INTO producto VALUES (1, 'Ratones', 'Logitech', 'M1', 'Ratón', 1, 5, 10, 21, 100, 100, 12.1, 0)",
+    "INSERT INTO categoria VALUES (1, 'Ratones', '../static/imagenes/ratones.png', 0)",
+)
+TABLAS = ("usuario", "proveedor", "producto", "categoria")
+
+
+@pytest.fixture
+def antigua(tmp_path):  # Engine de una base de datos con el esquema antiguo y una fila en cada tabla
+    engine = create_engine("sqlite:///{}".format(tmp_path / "antigua.db"))
+    with engine.begin() as conexion:
+        for sentencia in ESQUEMA_ANTIGUO:
+            conexion.execute(text(sentencia))
+    yield engine
+    engine.dispose()
+
+
+def test_migra_claves_no_cambia_nada_si_falla_una_tabla(antigua):
+    # Con la clave antigua podía haber dos categorías con el mismo id, que no caben en la tabla nueva
+    with antigua.begin() as conexion:
+        conexion.execute(text("INSERT INTO categoria VALUES (1, 'Ratones', '../static/imagenes/ratones.png', 1)"))
+    with pytest.raises(IntegrityError):
+        migraciones.migra_claves_primarias(antigua)
+    inspector = inspect(antigua)
+    assert sorted(inspector.get_table_names()) == sorted(TABLAS)  # Sin tablas _antigua
+    assert inspector.get_pk_constraint("usuario")["constrained_columns"] == ["id", "eliminado"]
+    with antigua.connect() as conexion:
+        for tabla in TABLAS:
+            assert conexion.execute(text("SELECT count(*) FROM {}".format(tabla))).scalar() > 0
+
+
+def test_migra_claves_de_una_base_de_datos_anterior_a_variantes(antigua):
+    # categoria no tiene la columna variantes: la migración copia las columnas que hay y actualiza_esquema añade el
+    # resto, como hace flask --app main migra-claves
+    assert migraciones.migra_claves_primarias(antigua) == list(TABLAS)
+    migraciones.actualiza_esquema(antigua)
+    inspector = inspect(antigua)
+    for tabla in TABLAS:
+        assert inspector.get_pk_constraint(tabla)["constrained_columns"] == ["id"]
+    with antigua.connect() as conexion:
+        assert conexion.execute(text("SELECT email FROM usuario")).scalars().all() == ["admin@tienda.es"]
+        assert conexion.execute(text("SELECT cantidad_max, stock FROM producto")).all() == [(100, 100)]
+        assert conexion.execute(text("SELECT nombre, variantes FROM categoria")).all() == [("Ratones", None)]
+    assert migraciones.migra_claves_primarias(antigua) == []  # Ya migradas, no hay nada que hacer
+
+
+def test_actualiza_esquema_quita_el_not_null_de_contabilidad(tmp_path):
+    # Antes id_cliente era obligatorio y las compras a proveedores (id_cliente vacío) no se podían guardar
+    engine = create_engine("sqlite:///{}".format(tmp_path / "contabilidad.db"))
+    with engine.begin() as conexion:
+        conexion.execute(text(
+            "CREATE TABLE contabilidad (id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, id_producto INTEGER NOT NULL, "
+            "id_cliente INTEGER NOT NULL, id_proveedor INTEGER NOT NULL, cantidad INTEGER NOT NULL, "
+            "fecha DATE NOT NULL, beneficio FLOAT NOT NULL)"))
+        conexion.execute(text("INSERT INTO contabilidad VALUES (7, 1, 2, 1, 3, '2024-01-01', 36.3)"))
+    migraciones.actualiza_esquema(engine)
+    columnas = {columna["name"]: columna for columna in inspect(engine).get_columns("contabilidad")}
+    assert columnas["id_cliente"]["nullable"]
+    with engine.begin() as conexion:
+        conexion.execute(text("INSERT INTO contabilidad (id_producto, id_cliente, id_proveedor, cantidad, fecha, "
+                              "beneficio) VALUES (1, NULL, 1, 5, '2024-01-02', 11.3)"))
+        assert conexion.execute(text("SELECT id, id_cliente FROM contabilidad ORDER BY id")).all() == [
+            (7, 2), (8, None)]
+    engine.dispose()
@@ -0,0 +1,76 @@
+import json
+import pytest
+import db
+import migraciones
+from models import Categoria, Factura, FacturaLinea, Pedido, PedidoLinea, Productos, Proveedor
+
+LINEAS = 3  # Productos de cada pedido
+
+
+@pytest.fixture
+def catalogo(base_datos, usuarios):  # Un proveedor con varios productos, devuelve sus ids
+    base_datos.add(Proveedor("Logitech", "B00000000", "910000000", "ventas@logitech.es", "Calle 3", "Madrid",
+                             "Madrid"))
+    base_datos.add(Categoria("Ratones", "../static/imagenes/ratones.png"))
+    base_datos.commit()
+    productos = [Productos("Ratones", "Logitech", "M{}".format(numero), "Ratón", 1, 5, 10, 100, 100)
+                 for numero in range(LINEAS)]
+    base_datos.add_all(productos)
+    base_datos.commit()
+    return [producto.id for producto in productos]
+
+
+def crea_pedidos(sesion, productos, total):  # Añade pedidos del cliente (id 2) hasta que haya total
+    for _ in range(total - sesion.query(Pedido).count()):
+        pedido = Pedido(2)
+        sesion.add(pedido)
+        sesion.flush()
+        sesion.add_all([PedidoLinea(pedido.id, id_producto, 1) for id_producto in productos])
+    sesion.commit()
+
+
+@pytest.mark.parametrize("email", ["admin@tienda.es", "cliente@tienda.es"])
+def test_pedidos_mismas_consultas_con_mas_pedidos(base_datos, catalogo, consultas, entra, email):
+    # Los clientes y los productos se cargan con una consulta para todos los pedidos, no una por pedido o línea
+    navegador = entra(email)
+    navegador.get("/pedidos")  # El usuario logueado ya queda en la caché de identidades
+    cuentas = []
+    for total in (1, 10, 40):
+        crea_pedidos(base_datos, catalogo, total)
+        consultas.clear()
+        assert navegador.get("/pedidos").status_code == 200
+        cuentas.append(len(consultas))
+    assert cuentas[0] == cuentas[1] == cuentas[2], cuentas
+
+
+def pedido_en_json(sesion, productos):  # Pedido como se guardaban antes de pedido_linea, sin líneas
+    pedido = Pedido(2, json.dumps([[str(id_producto), "2"] for id_producto in productos]))
+    sesion.add(pedido)
+    sesion.commit()
+    return pedido.id
+
+
+def test_actualiza_esquema_pasa_los_pedidos_en_json_a_lineas(base_datos, catalogo):
+    id_pedido = pedido_en_json(base_datos, catalogo)
+    assert migraciones.actualiza_esquema(db.engine) == 1
+    base_datos.remove()
+    assert base_datos.get(Pedido, id_pedido).pedido == "[]"
+    assert sorted(id for id, in base_datos.query(PedidoLinea.id_producto).filter_by(id_pedido=id_pedido)) == catalogo
+
+
+def test_facturar_un_pedido_en_json(base_datos, catalogo, entra):
+    id_pedido = pedido_en_json(base_datos, catalogo)
+    base_datos.remove()
+    assert entra("admin@tienda.es").post("/crear-factura", data={"pedido": id_pedido}).status_code == 302
+    factura = base_datos.query(Factura).one()
+    assert factura.total == round(LINEAS * 2 * 12.1, 2)  # 2 unidades de cada producto a 10 € más el 21% de IVA
+    assert base_datos.query(FacturaLinea).count() == LINEAS
+    assert base_datos.get(Pedido, id_pedido) is None
+
+
+def test_eliminar_un_pedido_en_json_repone_el_stock(base_datos, catalogo, entra):
+    id_pedido = pedido_en_json(base_datos, catalogo)
+    base_datos.remove()
+    assert entra("cliente@tienda.es").get("/eliminar_pedido/{}".format(id_pedido)).status_code == 302
+    assert base_datos.get(Pedido, id_pedido) is None
+    assert [stock for stock, in base_datos.query(Productos.stock)] == [102] * LINEAS